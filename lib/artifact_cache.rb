@@ -0,0 +1,101 @@
+require 'digest'
+require 'fileutils'
+require 'json'
+require 'thread'
+require 'tmpdir'
+
+# A content-addressed cache of intermediate files made by the slow steps of the pipeline (nucmer,
+# parsnp, harvesttools), which can be shared by runs with different OUT or OUT_PREFIX settings.
+#
+# Each entry is a subdirectory named by the SHA1 hash of the contents of the step's input files,
+# the versions of the tools it runs, and any parameters that change its outputs. Therefore, any
+# change to these invalidates the entry automatically. Entries are written to a temporary directory
+# first and then renamed, so that concurrent runs never see a partially written entry.
+class ArtifactCache
+
+  # Bump this whenever the layout of the cache changes, so that older entries are ignored
+  CACHE_VERSION = "1"
+  MANIFEST = "manifest.json"
+  HASH_BLOCK_BYTES = 1024 * 1024
+
+  def initialize(dir)
+    @dir = dir
+    @digests = {}
+    @digests_lock = Mutex.new
+  end
+
+  attr_reader :dir
+
+  # Returns the hex SHA1 hash of the contents of the file at `path`. Hashes are remembered for as
+  # long as the file keeps the same size and mtime, since the same inputs are often hashed repeatedly.
+  def file_digest(path)
+    stat = File.stat(path)
+    memo_key = [File.expand_path(path), stat.size, stat.mtime.to_f]
+    digest = @digests_lock.synchronize { @digests[memo_key] }
+    return digest if digest
+    sha1 = Digest::SHA1.new
+    File.open(path, 'rb') do |f|
+      while (block = f.read(HASH_BLOCK_BYTES))
+        sha1 << block
+      end
+    end
+    digest = sha1.hexdigest
+    @digests_lock.synchronize { @digests[memo_key] = digest }
+  end
+
+  # Returns the key for an entry made from the given options:
+  #   :inputs => Hash of names to paths (or an Array of paths) of input files, which are hashed by
+  #              their contents; names are part of the key, so use them only where they matter
+  #   :tools  => Array of executables, which are hashed by their contents, or version strings
+  #   :params => Hash of any other parameters affecting the outputs
+  def key(opts={})
+    inputs = opts[:inputs] || {}
+    inputs = Hash[inputs.each_with_index.map{ |path, i| [i, path] }] if inputs.is_a?(Array)
+    tools = (opts[:tools] || []).map{ |tool| File.file?(tool) ? file_digest(tool) : tool.to_s }
+    Digest::SHA1.hexdigest(JSON.generate([
+      CACHE_VERSION,
+      inputs.map{ |name, path| [name.to_s, file_digest(path)] }.sort,
+      tools,
+      (opts[:params] || {}).map{ |name, val| [name.to_s, val] }.sort_by(&:first)
+    ]))
+  end
+
+  # If there is an entry for `key`, copies its files to `outputs` (an Array of paths with unique
+  # basenames) and returns true. Otherwise, yields to build the `outputs`, saves a new entry with
+  # whichever of them exist, and returns false. Outputs are restored in the order they are given,
+  # so put the one that Rake checks last, and its mtime will be newest.
+  def fetch(key, outputs)
+    names = outputs.map{ |path| File.basename(path) }
+    raise ArgumentError, "outputs must have unique basenames" unless names.uniq.size == names.size
+    entry = File.join(@dir, key)
+    if File.exist?(File.join(entry, MANIFEST))
+      cached = JSON.parse(File.read(File.join(entry, MANIFEST)))
+      outputs.each do |path|
+        next unless cached.include?(File.basename(path))
+        # Copies (not hardlinks) are restored, so that tools overwriting outputs can't alter the cache
+        FileUtils.cp(File.join(entry, File.basename(path)), "#{path}.partial")
+        File.rename("#{path}.partial", path)
+      end
+      return true
+    end
+    yield
+    store(entry, outputs.select{ |path| File.file?(path) })
+    false
+  end
+
+  private
+
+  def store(entry, outputs)
+    FileUtils.mkdir_p(@dir)
+    tmp = Dir.mktmpdir(".#{File.basename(entry)}.", @dir)
+    outputs.each{ |path| FileUtils.cp(path, File.join(tmp, File.basename(path))) }
+    File.write(File.join(tmp, MANIFEST), JSON.generate(outputs.map{ |path| File.basename(path) }))
+    begin
+      File.rename(tmp, entry)
+    rescue SystemCallError
+      # Another run beat us to it; it would have saved the same outputs
+      FileUtils.rm_rf(tmp)
+    end
+  end
+
+end
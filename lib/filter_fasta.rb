@@ -1,8 +1,10 @@
 require 'bio'
 require 'tmpdir'
 require 'shellwords'
-require 'set'
 require 'fileutils'
+require 'thread'
+
+MUMMER_MODULE = "mummer/3.23"
 
 def filter_fasta_by_entry_id(in_path, out_path, regexp=/_[gm]_/, opts={})
   in_file = Bio::FlatFile.open(Bio::FastaFormat, in_path)
@@ -23,57 +25,113 @@ def filter_fasta_by_entry_id(in_path, out_path, regexp=/_[gm]_/, opts={})
   [matching_contigs, contig_count]
 end
 
-def find_repeats_with_mummer(fasta_path)
+# Merges an array of (0-based, end-exclusive) ranges into a sorted array of disjoint ranges,
+# joining any that overlap or touch. Empty ranges are dropped.
+def merge_ranges(ranges)
+  merged = []
+  ranges.reject{ |r| r.begin >= r.end }.sort_by{ |r| [r.begin, r.end] }.each do |r|
+    if merged.last && r.begin <= merged.last.end
+      merged[-1] = merged.last.begin...[merged.last.end, r.end].max
+    else
+      merged << r
+    end
+  end
+  merged
+end
+
+# Finds repeats within each contig of a fasta by aligning it to itself with nucmer, whose outputs
+# are written into a new temporary directory, or `tmp_dir` if given. Raises if nucmer fails.
+def find_repeats_with_mummer(fasta_path, tmp_dir=nil)
+  return Dir.mktmpdir{ |tmp| find_repeats_with_mummer(fasta_path, tmp) } unless tmp_dir
   repeat_mask = {}
   start_reading = false
-  Dir.mktmpdir do |tmp|
-    system <<-SH
-      module load mummer/3.23
-      nucmer --maxmatch --nosimplify --prefix #{tmp}/repeats \
-          #{Shellwords.escape(fasta_path)} #{Shellwords.escape(fasta_path)}
-      show-coords #{tmp}/repeats.delta > #{tmp}/repeats.coords
-    SH
-    File.open("#{tmp}/repeats.coords", 'r').each_line do |line|
-      if line =~ /^==========/ then start_reading = true; next; end
-      next unless start_reading
-      vals = line.strip.split(/[\s|]+/)
-      start1, end1, start2, end2 = vals[0..3].map{|v| v.to_i }
-      query_contig, subject_contig = vals[7..8]
-      repeat_mask[query_contig] ||= Set.new
-      repeat_mask[subject_contig] ||= Set.new
-      if (start1 != start2 || end1 != end2) && query_contig == subject_contig
-        # Store all (0-based) positions that matched a repeat sequence within the same contig
-        repeat_mask[query_contig].merge((start1 - 1)...end1)
-        repeat_mask[query_contig].merge((start2 - 1)...end2)
-      end
+  succeeded = system <<-SH
+    module load #{MUMMER_MODULE}
+    nucmer --maxmatch --nosimplify --prefix #{tmp_dir}/repeats \
+        #{Shellwords.escape(fasta_path)} #{Shellwords.escape(fasta_path)} &&
+    show-coords #{tmp_dir}/repeats.delta > #{tmp_dir}/repeats.coords
+  SH
+  raise "nucmer or show-coords failed for #{fasta_path}" unless succeeded
+  File.open("#{tmp_dir}/repeats.coords", 'r').each_line do |line|
+    if line =~ /^==========/ then start_reading = true; next; end
+    next unless start_reading
+    vals = line.strip.split(/[\s|]+/)
+    start1, end1, start2, end2 = vals[0..3].map{|v| v.to_i }
+    query_contig, subject_contig = vals[7..8]
+    repeat_mask[query_contig] ||= []
+    repeat_mask[subject_contig] ||= []
+    if (start1 != start2 || end1 != end2) && query_contig == subject_contig
+      # Store the (0-based) ranges that matched a repeat sequence within the same contig
+      # Reversed alignments (start2 > end2) give empty ranges, which are dropped when merging
+      repeat_mask[query_contig] << ((start1 - 1)...end1)
+      repeat_mask[query_contig] << ((start2 - 1)...end2)
     end
   end
-  repeat_mask
+  Hash[repeat_mask.map{ |contig, ranges| [contig, merge_ranges(ranges)] }]
 end
 
-def fasta_mask_repeats(in_path, out_path)
-  repeat_mask = find_repeats_with_mummer(in_path)
+# The nucmer and show-coords executables in MUMMER_MODULE, so that cached masks are keyed by the
+# tools themselves and not only the module's name. Empty if they can't be found.
+def mummer_tool_paths
+  @mummer_tool_paths ||= begin
+    paths = `module load #{MUMMER_MODULE} 2>/dev/null; which nucmer show-coords 2>/dev/null`
+    paths.split("\n").map(&:strip).select{ |path| File.file?(path) }
+  end
+end
+
+# If an ArtifactCache is given as `cache`, a previously masked copy of the same sequences is reused.
+# Failures in nucmer raise before anything is saved, so a bad mask is never cached.
+def fasta_mask_repeats(in_path, out_path, tmp_dir=nil, cache=nil)
+  if cache
+    tools = [MUMMER_MODULE] + mummer_tool_paths
+    key = cache.key(inputs: [in_path], tools: tools, params: {task: "repeat_mask"})
+    cache.fetch(key, [out_path]) { fasta_mask_repeats(in_path, out_path, tmp_dir) }
+    return
+  end
+  repeat_mask = find_repeats_with_mummer(in_path, tmp_dir)
   in_file = Bio::FlatFile.open(Bio::FastaFormat, in_path)
   
-  File.open(out_path, 'w') do |out_file|
+  # Written under a temporary name first, so an interrupted run never leaves a partial out_path
+  File.open("#{out_path}.partial", 'w') do |out_file|
     in_file.each_entry do |entry|
       if repeat_mask.include?(entry.entry_id)
         # Masking is done by contiguous ranges, not characterwise, to save on thrashing memory
-        start_mask = nil
-        end_mask = nil
-        repeat_mask[entry.entry_id].to_a.sort.each do |pos|
-          start_mask ||= pos
-          # Everytime we skip to another contiguous range of the contig, mask the last range
-          if end_mask && pos != end_mask + 1
-            entry.seq[start_mask..end_mask] = 'n' * (end_mask - start_mask + 1)
-            start_mask = pos
-          end
-          end_mask = pos
-        end
-        # Mask the very last range
-        entry.seq[start_mask..end_mask] = 'n' * (end_mask - start_mask + 1) if start_mask
+        seq = entry.seq
+        repeat_mask[entry.entry_id].each { |r| seq[r] = 'n' * r.size }
       end
       out_file.puts(entry.seq.to_fasta(entry.entry_id, 60))
     end
   end
-end
\ No newline at end of file
+  File.rename("#{out_path}.partial", out_path)
+end
+
+# Masks repeats in many fastas at once, using a pool of `workers` threads. Each job runs nucmer in
+# a new temporary directory, so a failed job can never read another job's outputs. `jobs` is an
+# array of [in_path, out_path] pairs. If a block is given, it is called with each pair within the
+# worker, before masking, e.g. to create in_path.
+# Returns an array of error messages for any jobs that failed; the others are still completed.
+def fasta_mask_repeats_batch(jobs, workers=1, cache=nil)
+  queue = Queue.new
+  jobs.each{ |job| queue << job }
+  errors = []
+  errors_lock = Mutex.new
+  threads = [[workers, jobs.size].min, 1].max.times.map do
+    Thread.new do
+      loop do
+        begin
+          in_path, out_path = queue.pop(true)
+        rescue ThreadError
+          break
+        end
+        begin
+          yield in_path, out_path if block_given?
+          fasta_mask_repeats(in_path, out_path, nil, cache)
+        rescue StandardError => e
+          errors_lock.synchronize { errors << "#{in_path}: #{e.message}" }
+        end
+      end
+    end
+  end
+  threads.each(&:join)
+  errors
+end
@@ -46,6 +46,8 @@ class LSFClient
   
   def disable!; @disabled = true; end
   
+  def disabled?; @disabled; end
+  
   def bsub(script, options=nil)
     return system(script) if @disabled
     
@@ -0,0 +1,102 @@
+require 'thread'
+
+# Runs parsnp for many mash clusters concurrently, within a budget of CPU cores and memory (in GB).
+# Clusters are started largest first, since they take the longest, and each is given a number of
+# parsnp threads in proportion to its share of all the genomes being aligned. Whenever the next
+# largest cluster doesn't fit in what remains of the budget, smaller clusters that do are started.
+#
+# Jobs run locally, or are submitted to LSF with `bsub -K` if an enabled LSFClient is given.
+class ParsnpScheduler
+
+  # A rough guess at how much memory parsnp needs per bacterial genome, plus a constant overhead
+  MEM_GB_PER_GENOME = 0.05
+  MIN_MEM_GB = 1.0
+
+  def initialize(cores=1, mem_gb=nil, lsf=nil)
+    @cores = [cores.to_i, 1].max
+    @mem_gb = mem_gb && mem_gb.to_f
+    @lsf = lsf
+  end
+
+  attr_reader :cores, :mem_gb
+
+  # The number of parsnp threads for a cluster of `size` genomes, out of `total_size` genomes in
+  # all of the clusters that are being run at once. Never more than the cores or the genomes.
+  def threads_for(size, total_size=size)
+    share = (@cores * size.to_f / [total_size, 1].max).round
+    [[share, size, @cores].min, 1].max
+  end
+
+  # The memory in GB that is reserved for a cluster of `size` genomes, never more than the budget,
+  # so that even a cluster larger than expected can run once everything else has finished.
+  def mem_gb_for(size)
+    mem_gb = [MIN_MEM_GB, size * MEM_GB_PER_GENOME].max
+    @mem_gb ? [mem_gb, @mem_gb].min : mem_gb
+  end
+
+  # Runs the shell `script` locally, or through LSF with the given number of `threads` and memory,
+  # waiting for it to finish. Returns true if it succeeded.
+  def dispatch(script, threads=1, mem_gb=MIN_MEM_GB)
+    return system(script) ? true : false unless @lsf && !@lsf.disabled?
+    # LSF reserves memory per slot (in MB), and we ask for one slot per thread on a single host
+    mem_mb = (mem_gb * 1024 / threads).ceil
+    @lsf.bsub_wait(script, :n => threads, :R => "rusage[mem=#{mem_mb}] span[hosts=1]")
+    $?.success?
+  end
+
+  # Runs `jobs`, an array of [job, size] pairs, concurrently within the budget. For each, the block
+  # is called from a separate thread with the job, its number of threads, and a lambda that
+  # dispatches a shell script for it (see `dispatch`) and returns true if it succeeded.
+  # Returns an array of error messages for any jobs that failed; the others are still completed.
+  def run(jobs)
+    pending = jobs.sort_by{ |_, size| -size }
+    total_size = jobs.map{ |_, size| size }.inject(0, :+)
+    free_cores = @cores
+    free_mem_gb = @mem_gb
+    running = 0
+    errors = []
+    threads = []
+    lock = Mutex.new
+    finished = ConditionVariable.new
+
+    lock.synchronize do
+      until pending.empty?
+        fits = pending.find do |_, size|
+          threads_for(size, total_size) <= free_cores &&
+              (free_mem_gb.nil? || mem_gb_for(size) <= free_mem_gb + 1e-9)
+        end
+        # If nothing is running, the largest pending job must start, even if it's over budget
+        fits ||= pending.first if running == 0
+        next finished.wait(lock) unless fits
+
+        pending.delete(fits)
+        job, size = fits
+        job_threads = threads_for(size, total_size)
+        job_mem_gb = mem_gb_for(size)
+        free_cores -= job_threads
+        free_mem_gb -= job_mem_gb if free_mem_gb
+        running += 1
+        # The loop reassigns these variables, so each thread is given its own copies as arguments
+        threads << Thread.new(job, job_threads, job_mem_gb) do |this_job, this_threads, this_mem_gb|
+          begin
+            runner = lambda{ |script| dispatch(script, this_threads, this_mem_gb) }
+            yield this_job, this_threads, runner
+          rescue StandardError, SystemExit => e
+            # A job that calls `abort` is recorded as failed, rather than killing the running jobs
+            lock.synchronize { errors << "#{this_job}: #{e.message}" }
+          ensure
+            lock.synchronize do
+              free_cores += this_threads
+              free_mem_gb += this_mem_gb if free_mem_gb
+              running -= 1
+              finished.signal
+            end
+          end
+        end
+      end
+    end
+    threads.each(&:join)
+    errors
+  end
+
+end
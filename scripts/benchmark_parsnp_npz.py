@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Benchmarks typical requests from visualizations against a .parsnp.vcfs.npz file, comparing the
+indexed, memory-mapped queries in pylib.parsnp_npz against loading whole arrays with np.load().
+
+If no .npz file is given, a random one is created in a temporary directory.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+from pylib.parsnp_vcf import ALLELE_INFO_DTYPE
+from pylib.parsnp_npz import ParsnpNpz
+
+
+def random_npz(path, n_clusters, n_genomes, n_variants, n_chroms=2, seed=0):
+    rand = np.random.RandomState(seed)
+    vcf_data = {}
+    for i in range(n_clusters):
+        alleles = rand.randint(1, 4, size=(n_variants, n_genomes)).astype(np.int16)
+        alleles[rand.random_sample((n_variants, n_genomes)) >= 0.05] = 0
+        allele_info = np.zeros(n_variants, dtype=ALLELE_INFO_DTYPE)
+        allele_info['chrom'] = np.repeat(['chr%d' % (c + 1) for c in range(n_chroms)],
+                -(-n_variants // n_chroms))[:n_variants]
+        allele_info['pos'] = np.sort(rand.randint(1, 5000000, size=n_variants))
+        allele_info['alt'] = 'A,C,G,T'
+        vcf_data['vcf_mat_%d' % i] = alleles.T
+        vcf_data['vcf_allele_info_%d' % i] = allele_info
+        vcf_data['seq_list_%d' % i] = np.array(['C%03dG%04d' % (i, j) for j in range(n_genomes)])
+    np.savez(path, **vcf_data)
+
+
+def naive_subset(npz_path, genomes, chrom=None, start=None, end=None):
+    """How these requests are answered without an index: load everything, then search it."""
+    npz = np.load(npz_path)
+    for key in npz.keys():
+        if key.startswith('seq_list_'):
+            seq_list = list(npz[key])
+            if genomes[0] in seq_list:
+                i = key[len('seq_list_'):]
+                break
+    rows = [seq_list.index(genome) for genome in genomes]
+    allele_info = npz['vcf_allele_info_' + i]
+    keep = np.ones(len(allele_info), dtype=bool)
+    if chrom is not None: keep &= allele_info['chrom'] == chrom
+    if start is not None: keep &= allele_info['pos'] >= start
+    if end is not None: keep &= allele_info['pos'] <= end
+    vcf_mat = npz['vcf_mat_' + i][rows][:, keep]
+    polymorphic = (vcf_mat != vcf_mat[0]).any(axis=0)
+    return vcf_mat[:, polymorphic], allele_info[keep][polymorphic]
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('npz', metavar='PARSNP_VCFS_NPZ', nargs='?', default=None,
+            help='Path to a .parsnp.vcfs.npz file (or shard directory) to benchmark against')
+    parser.add_argument("-c", "--num_clusters", type=int, default=50,
+            help="Number of clusters in a random .npz; default=50")
+    parser.add_argument("-g", "--num_genomes", type=int, default=200,
+            help="Number of genomes per cluster in a random .npz; default=200")
+    parser.add_argument("-v", "--num_variants", type=int, default=50000,
+            help="Number of variants per cluster in a random .npz; default=50000")
+    parser.add_argument("-r", "--repeats", type=int, default=20,
+            help="Number of times each kind of request is made; default=20")
+    args = parser.parse_args()
+    if args.npz is not None and os.path.isdir(args.npz):
+        parser.error("the naive method can only load .npz files, not shard directories")
+
+    tmp_dir = None
+    npz_path = args.npz
+    if npz_path is None:
+        tmp_dir = tempfile.mkdtemp()
+        npz_path = os.path.join(tmp_dir, 'random.parsnp.vcfs.npz')
+        random_npz(npz_path, args.num_clusters, args.num_genomes, args.num_variants)
+
+    try:
+        start = time.time()
+        npz = ParsnpNpz(npz_path)
+        sys.stdout.write("Opened and indexed %d genomes in %d clusters in %.3fs\n\n" %
+                (len(npz.genomes), npz.num_clusters, time.time() - start))
+
+        random.seed(0)
+        genomes_by_cluster = {}
+        for genome, (cluster, _) in npz.genomes.iteritems():
+            genomes_by_cluster.setdefault(cluster, []).append(genome)
+        clusters = sorted(genomes_by_cluster.keys())
+
+        def whole_cluster():
+            genomes = genomes_by_cluster[random.choice(clusters)]
+            return (genomes, None, None, None)
+        def ten_genomes():
+            genomes = genomes_by_cluster[random.choice(clusters)]
+            return (random.sample(genomes, min(10, len(genomes))), None, None, None)
+        def ten_genomes_in_range():
+            genomes, _, _, _ = ten_genomes()
+            cluster = npz.genomes[genomes[0]][0]
+            allele_info = npz.array(cluster, 'vcf_allele_info')
+            site = random.randrange(len(allele_info)) if len(allele_info) > 0 else None
+            if site is None: return (genomes, None, None, None)
+            chrom, pos = allele_info['chrom'][site], int(allele_info['pos'][site])
+            return (genomes, chrom, pos, pos + 50000)
+
+        sys.stdout.write("request\tindexed_s\tnaive_s\tspeedup\n")
+        for name, make_request in (("whole cluster", whole_cluster), ("10 genomes", ten_genomes),
+                ("10 genomes, 50kb range", ten_genomes_in_range)):
+            requests = [make_request() for _ in range(args.repeats)]
+            indexed_secs = sum(timed(npz.subset, *request) for request in requests) / len(requests)
+            naive_secs = sum(timed(naive_subset, npz_path, *request) for request in requests)
+            naive_secs /= len(requests)
+            sys.stdout.write("%s\t%.4f\t%.4f\t%.1fx\n" % (name, indexed_secs, naive_secs,
+                    naive_secs / indexed_secs))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
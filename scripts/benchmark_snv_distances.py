@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Benchmarks the all-pairs SNV distance calculation used by parsnp2table.py on random matrices of
+alleles, comparing the original double loop over rows against the tiled engine in
+pylib.snv_distances (both for int16 alleles and for bit-packed genotypes).
+
+The original double loop takes hours for thousands of genomes, so it is only timed for the first
+--loop_rows rows, and that time is scaled up to the full matrix.
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+
+from pylib.packed_genotypes import pack_genotypes
+from pylib.snv_distances import snv_distances
+
+
+def random_alleles(n_seqs, n_variants, alt_fraction, seed=0):
+    rand = np.random.RandomState(seed)
+    alleles = rand.randint(1, 4, size=(n_variants, n_seqs)).astype(np.int16)
+    alleles[rand.random_sample((n_variants, n_seqs)) >= alt_fraction] = 0
+    # Match the Fortran-ordered layout that load_parsnp_vcf() returns
+    return alleles.T
+
+
+def loop_distances(vcf_mat, rows):
+    dist_mat = np.zeros((rows, vcf_mat.shape[0]))
+    for i in range(rows):
+        for j in range(vcf_mat.shape[0]):
+            dist_mat[i, j] = np.count_nonzero(vcf_mat[i, :] - vcf_mat[j, :])
+    return dist_mat
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--num_genomes", type=int, nargs='+', default=[100, 500, 2000],
+            help="Numbers of genomes to benchmark; default=100 500 2000")
+    parser.add_argument("-v", "--num_variants", type=int, default=20000,
+            help="Number of variants in each matrix of alleles; default=20000")
+    parser.add_argument("-a", "--alt_fraction", type=float, default=0.05,
+            help="Fraction of alleles that are not the REF; default=0.05")
+    parser.add_argument("-l", "--loop_rows", type=int, default=20,
+            help="Number of rows to time the original double loop for; default=20")
+    args = parser.parse_args()
+
+    print "genomes\tvariants\tloop_s\ttiled_s\tpacked_s\ttiled_speedup\tpacked_speedup"
+    for n_seqs in args.num_genomes:
+        vcf_mat = random_alleles(n_seqs, args.num_variants, args.alt_fraction)
+        rows = min(args.loop_rows, n_seqs)
+        loop_mat, loop_secs = timed(loop_distances, vcf_mat, rows)
+        loop_secs *= float(n_seqs) / rows
+        tiled_mat, tiled_secs = timed(snv_distances, vcf_mat)
+        packed_mat, packed_secs = timed(lambda: snv_distances(pack_genotypes(vcf_mat), packed=True))
+        if not (np.array_equal(tiled_mat[:rows], loop_mat) and np.array_equal(tiled_mat, packed_mat)):
+            sys.stderr.write("FATAL: distances differ between methods for %d genomes\n" % n_seqs)
+            sys.exit(1)
+        print "%d\t%d\t%.2f\t%.2f\t%.2f\t%.1fx\t%.1fx" % (n_seqs, args.num_variants, loop_secs,
+                tiled_secs, packed_secs, loop_secs / tiled_secs, loop_secs / packed_secs)
+        sys.stdout.flush()
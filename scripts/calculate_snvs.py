@@ -5,8 +5,11 @@ import argparse
 import shutil
 import _mysql
 import datetime
-import networkx as nx
+import numpy as np
 from itertools import groupby
+from collections import OrderedDict
+
+from mash_clusters import mash_dist_table
 
 
 
@@ -24,37 +27,131 @@ def get_fasta_list(fasta_name):
                 out_list.append((header, seq))
     return out_list
 
-def group_snvs(fasta_list, mash, working_dir, max_cluster_size):
-    G = nx.Graph()
-    subprocess.Popen(mash + ' sketch -o ' + working_dir + '/reference.msh ' + ' '.join(fasta_list), shell=True).wait()
+class Components(object):
+    """
+    Connected components over node indices 0..n-1, as a disjoint-set forest that tracks the size
+    of each component, so that edges can be added one at a time in near-constant time.
+    """
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, first, second, max_size):
+        """
+        Joins the components of `first` and `second`, unless that would create a component with
+        more than `max_size` nodes. Returns False if they couldn't be joined.
+        """
+        first, second = self.find(first), self.find(second)
+        if first == second:
+            return True
+        if self.size[first] + self.size[second] > max_size:
+            return False
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+        return True
+
+    def groups(self):
+        """Returns the nodes in each component, in order of their lowest node."""
+        groups = OrderedDict()
+        for node in range(len(self.parent)):
+            groups.setdefault(self.find(node), []).append(node)
+        return groups.values()
+
+
+def mash_dist_edges(fasta_list, mash, sketch, cutoff):
+    """
+    Runs `mash dist` of each fasta against the sketch, returning a sorted list of (distance,
+    reference index, query index) edges that are within `cutoff`.
+    """
+    node_index = dict((fasta, i) for i, fasta in enumerate(fasta_list))
     edge_list = []
-    cutoff = 0.75
-    for file in fasta_list:
-        process = subprocess.Popen(mash + ' dist ' + working_dir + '/reference.msh ' + file, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    for fasta in fasta_list:
+        process = subprocess.Popen([mash, 'dist', sketch, fasta], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
         for line in process.stdout:
             fasta_a, fasta_b, dist = line.split()[:3]
             if float(dist) <= cutoff:
-                G.add_node(fasta_a)
-                G.add_node(fasta_b)
                 edge_list.append((float(dist), fasta_a, fasta_b))
+        process.wait()
+    # Ties are broken by the names of the fastas, as they always have been
     edge_list.sort()
-    for i in edge_list:
-        print i
-        G.add_edge(i[1], i[2])
-        new_out_groups = []
-        subgraphs = nx.connected_component_subgraphs(G)
-        for sg in subgraphs:
-            group = []
-            for node in sg.nodes():
-                group.append(node)
-            if len(group) > max_cluster_size:
-                return out_groups
-            new_out_groups.append(group)
-        out_groups = new_out_groups
-    return out_groups
+    return [(dist, node_index[fasta_a], node_index[fasta_b]) for dist, fasta_a, fasta_b in edge_list]
+
+
+def mash_dist_table_edges(fasta_list, mash, sketch, cutoff, threads):
+    """
+    Same as `mash_dist_edges()`, but compares the sketch against itself in one `mash dist -t` run
+    with `threads` threads, and finds and sorts the edges with NumPy. Distances are parsed as
+    float64, like float() does, so that ties and the cutoff fall the same way as in that function.
+    """
+    node_index = dict((fasta, i) for i, fasta in enumerate(fasta_list))
+    queries, refs, dists = [], [], []
+    for query, row in mash_dist_table(sketch, [sketch], node_index, mash, threads, np.float64):
+        ref = np.flatnonzero(row <= cutoff)
+        queries.append(np.full(len(ref), query, dtype=np.intp))
+        refs.append(ref)
+        dists.append(row[ref])
+    if len(dists) == 0:
+        return []
+    queries, refs, dists = np.concatenate(queries), np.concatenate(refs), np.concatenate(dists)
+    name_rank = np.argsort(np.argsort(np.array(fasta_list)))
+    order = np.lexsort((name_rank[queries], name_rank[refs], dists))
+    return zip(dists[order].tolist(), refs[order].tolist(), queries[order].tolist())
+
+
+def group_snvs(fasta_list, mash, working_dir, max_cluster_size, threads=None):
+    """
+    Groups the fastas by adding edges between them for Mash distances within a cutoff, from the
+    shortest to the longest, until one more edge would create a group of more than
+    `max_cluster_size` fastas. Groups are returned in the order of their first fasta in
+    `fasta_list`, and list their fastas in that same order.
+
+    If `threads` is set, all Mash distances are calculated in one run of `mash dist` with that
+    many threads, instead of one run per fasta.
+    """
+    sketch = working_dir + '/reference.msh'
+    subprocess.Popen([mash, 'sketch', '-o', sketch] + list(fasta_list)).wait()
+    cutoff = 0.75
+    if threads is not None:
+        edge_list = mash_dist_table_edges(fasta_list, mash, sketch, cutoff, threads)
+    else:
+        edge_list = mash_dist_edges(fasta_list, mash, sketch, cutoff)
+    components = Components(len(fasta_list))
+    for dist, fasta_a, fasta_b in edge_list:
+        if not components.union(fasta_a, fasta_b, max_cluster_size):
+            break
+    return [[fasta_list[i] for i in group] for group in components.groups()]
+
+
+def merge_intervals(intervals):
+    """
+    Merges a list of (start, end) half-open intervals into a sorted list of disjoint intervals,
+    joining any that overlap or touch. Empty intervals are dropped.
+    """
+    merged = []
+    for start, end in sorted(interval for interval in intervals if interval[0] < interval[1]):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 def get_repeats(infile, working_dir):
+    """
+    Finds repeats within each contig of `infile` by aligning it to itself with nucmer. Returns a
+    dict of contig names to sorted, merged lists of (start, end) intervals of 0-based positions.
+    """
     subprocess.Popen('nucmer --maxmatch --nosimplify --prefix ' + working_dir + '/repeats ' + infile + ' ' + infile, stderr=subprocess.PIPE, shell=True).wait()
     subprocess.Popen('show-coords ' + working_dir + '/repeats.delta > ' + working_dir + '/repeats.coords', shell=True).wait()
     with open(working_dir + '/repeats.coords') as f:
@@ -68,20 +165,33 @@ def get_repeats(infile, working_dir):
                 s1, e1, s2, e2 = map(int, (s1, e1, s2, e2))
                 query, subject = line.split()[11:]
                 if not query in repeat_dict:
-                    repeat_dict[query] = set()
+                    repeat_dict[query] = []
                 if not subject in repeat_dict:
-                    repeat_dict[subject] = set()
+                    repeat_dict[subject] = []
                 if (s1 != s2 or e1 != e2) and query == subject:
-                    for i in range(s1-1, e1):
-                        repeat_dict[query].add(i)
-                    for i in range(s2-1, e2):
-                        repeat_dict[subject].add(i)
-    repeat_count = 0
-    for i in repeat_dict:
-        repeat_count += len(repeat_dict[i])
+                    # Reversed alignments (s2 > e2) give empty intervals, which are dropped
+                    repeat_dict[query].append((s1 - 1, e1))
+                    repeat_dict[subject].append((s2 - 1, e2))
+    for contig in repeat_dict:
+        repeat_dict[contig] = merge_intervals(repeat_dict[contig])
     return repeat_dict
 
 
+def mask_repeats(seq, repeats):
+    """
+    Replaces the bases of `seq` within the `repeats` intervals with 'n'.
+    Returns the masked sequence and the number of bases left unmasked.
+    """
+    masked = bytearray(seq)
+    length = len(masked)
+    for start, end in repeats:
+        end = min(end, len(masked))
+        if start < end:
+            masked[start:end] = 'n' * (end - start)
+            length -= end - start
+    return str(masked), length
+
+
 def run_parsnp(out_groups, working_dir, parsnp, harvesttools, min_length):
     fastas = []
     filtered = []
@@ -101,13 +211,8 @@ def run_parsnp(out_groups, working_dir, parsnp, harvesttools, min_length):
                 new_contig_list = []
                 length = 0
                 for k in contig_list:
-                    new_seq = ''
-                    for pos, l in enumerate(k[1]):
-                        if k[0] in repeat_dict and pos in repeat_dict[k[0]]:
-                            new_seq += 'n'
-                        else:
-                            new_seq += l
-                            length += 1
+                    new_seq, unmasked = mask_repeats(k[1], repeat_dict.get(k[0], []))
+                    length += unmasked
                     new_contig_list.append((k[0], new_seq))
                 contig_list = new_contig_list
                 print j, length
@@ -279,7 +384,8 @@ parser.add_argument("-p", "--path_to_parsnp", default='parsnp', help="Path to pa
 parser.add_argument("-t", "--path_to_harvest", default='harvesttools', help="Path to harvesttools binary")
 parser.add_argument("-d", "--working_dir", help="working directory")
 parser.add_argument("-x", "--database_only", default=False, action='store_true', help="when given an existing directory calculate mumi can update the snv count with information from pathogendb")
-parser.add_argument("-c", "--max_cluster_size", default=100, help="maximum number of genomes to include in a cluster to be run through parsnp")
+parser.add_argument("-c", "--max_cluster_size", type=int, default=100, help="maximum number of genomes to include in a cluster to be run through parsnp")
+parser.add_argument("-n", "--mash_threads", type=int, default=None, help="if given, calculate all mash distances in one run of mash dist with this many threads")
 parser.add_argument("-l", "--min_length", default=2000000, help="minimum length of the genome after repeat filtering for inclusion in a cluster")
 args = parser.parse_args()
 
@@ -298,7 +404,8 @@ else:
                 fasta_list.append(line.rstrip())
     else:
         fasta_list = args.fastas
-    out_groups = group_snvs(fasta_list, args.path_to_mash, args.working_dir, args.max_cluster_size)
+    out_groups = group_snvs(fasta_list, args.path_to_mash, args.working_dir, args.max_cluster_size,
+            args.mash_threads)
     filtered, stats = run_parsnp(out_groups, args.working_dir, args.path_to_parsnp, args.path_to_harvest, args.min_length)
     create_json(args.working_dir, args.output)
     for num, i in enumerate(out_groups):
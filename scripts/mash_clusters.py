@@ -9,14 +9,18 @@ import sys
 import os
 import subprocess
 import argparse
-import pickle
-from itertools import permutations, chain
+import numpy as np
+from itertools import chain
 from tqdm import tqdm
 
 
 DEFAULT_MAX_DIAMETER = 0.02
 DEFAULT_MAX_CLUSTER_SIZE = 100
 SUBPROCESS_KWARGS = {"shell": False, "stdout": subprocess.PIPE, "stderr": subprocess.PIPE}
+# float32 holds the ~6 significant digits that `mash dist` prints at half the size of float64
+DISTANCE_DTYPE = np.float32
+# Number of matrix columns scanned at a time when extracting edges
+EDGE_BLOCK_SIZE = 1024
 
 
 def get_fasta_list(mash_sketch_file, path_to_mash='mash'):
@@ -29,127 +33,413 @@ def get_fasta_list(mash_sketch_file, path_to_mash='mash'):
     return fasta_list
 
 
-def find_node_in_clusters(node, clusters):
-    try:
-        return next(i for i, cluster in enumerate(clusters) if node in cluster)
-    except StopIteration: 
-        return None
-        
-
-def diameter(cluster, distances, merging_into=None, diameter_cache=None):
-    # Use list() to copy and avoid ever modifying the original cluster
-    cluster = list(cluster)
-    have_cache = isinstance(diameter_cache, dict)
-    cached = None
-    
-    if have_cache: cached = diameter_cache.get(tuple(sorted(cluster)), None)
-        
-    if merging_into is not None:
-        if cached is not None and len(merging_into) == 1:
-            # As an optimization, when considering adding ONE node to an existing cluster,
-            # only the distances between the new node and all previous nodes in the cluster
-            # plus the cluster's current diameter need to be compared
-            new_distances = [distances[merging_into[0], node] for node in cluster]
-            new_diameter = max(new_distances + [cached])
-            cluster.extend(merging_into)
-            diameter_cache[tuple(sorted(cluster))] = new_diameter
-            return new_diameter
-        else:
-            cluster.extend(merging_into)
-            if have_cache: cached = diameter_cache.get(tuple(sorted(cluster)), None)
+class ClusterForest(object):
+    """
+    A disjoint-set forest over node indices 0..n-1, with path compression and union by size.
+    
+    Each root also tracks its cluster's size, diameter, member indices (in the order they were
+    added), the order in which the cluster was created, and an id that changes whenever the
+    cluster's membership does. Diameters of merge candidates are computed from one block of the
+    `distances` matrix and cached under those ids, so candidates that are rejected again and
+    again (as in greedy clustering) are only ever computed once.
+    """
+    
+    def __init__(self, distances):
+        n = distances.shape[0]
+        self.distances = distances
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.diameter = [0] * n
+        self.created = [None] * n
+        self.cluster_id = list(range(n))
+        self.next_cluster_id = n
+        self.num_created = 0
+        self._members = {}
+        self._cross_diameters = {}
+    
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            # Path halving: point every other node on the path at its grandparent
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    
+    def in_cluster(self, root):
+        """Has the node at `root` been placed into a cluster yet (i.e., not left as a singleton)?"""
+        return self.created[root] is not None
+    
+    def members(self, root):
+        members = self._members.get(root)
+        return members if members is not None else np.array([root], dtype=np.intp)
+    
+    def merged_diameter(self, first, second):
+        """
+        The diameter the clusters rooted at `first` and `second` would have if merged: the larger
+        of their current diameters, and the largest distance between a member of each.
+        Mash distances are symmetric, so only the [first, second] block is consulted.
+        """
+        first_id, second_id = self.cluster_id[first], self.cluster_id[second]
+        cross = self._cross_diameters.get(first_id, {}).get(second_id)
+        if cross is None:
+            cross = self.distances[np.ix_(self.members(first), self.members(second))].max()
+            self._cross_diameters.setdefault(first_id, {})[second_id] = cross
+            self._cross_diameters.setdefault(second_id, {})[first_id] = cross
+        return max(self.diameter[first], self.diameter[second], cross)
+    
+    def _forget(self, cluster_id):
+        for other_id in self._cross_diameters.pop(cluster_id, {}):
+            self._cross_diameters[other_id].pop(cluster_id, None)
     
-    if cached is not None: return cached
+    def union(self, first, second, new_diameter):
+        """
+        Merges the clusters rooted at `first` and `second`. Members of `second` are placed after
+        members of `first`, and the merged cluster keeps the creation order of `first`.
+        Returns the new root.
+        """
+        if not self.in_cluster(first):
+            self.created[first] = self.num_created
+            self.num_created += 1
+        root, child = (first, second) if self.size[first] >= self.size[second] else (second, first)
+        self._forget(self.cluster_id[first])
+        self._forget(self.cluster_id[second])
+        members = np.concatenate((self.members(first), self.members(second)))
+        self._members.pop(child, None)
+        self._members[root] = members
+        self.parent[child] = root
+        self.created[root] = self.created[first]
+        self.size[root] += self.size[child]
+        self.diameter[root] = new_diameter
+        self.cluster_id[root] = self.next_cluster_id
+        self.next_cluster_id += 1
+        return root
+    
+    def clusters(self):
+        """Returns a list of member lists for every cluster, in order of creation."""
+        roots = [i for i in range(len(self.parent)) if self.parent[i] == i and self.in_cluster(i)]
+        roots.sort(key=lambda root: self.created[root])
+        return [self.members(root).tolist() for root in roots]
+
+
+def diameter(cluster, distances):
+    """
+    The largest distance between any two nodes in `cluster`, a list of node indices into the
+    `distances` matrix.
+    """
     if len(cluster) < 2: return 0
+    return distances[np.ix_(cluster, cluster)].max()
+
+
+def distance_matrix_paths(mash_sketch_file):
+    """Paths for the cached distance matrix (.npy) and the list of node names for its rows."""
+    return mash_sketch_file + ".distances.npy", mash_sketch_file + ".distances.txt"
+
+
+def load_distance_matrix(mash_sketch_file):
+    """
+    Memory-maps a distance matrix previously cached by `mash_distances_edges()`.
+    Returns the list of node names for its rows and the matrix, or (None, None) if there is none.
+    """
+    cached_path, names_path = distance_matrix_paths(mash_sketch_file)
+    if not (os.access(cached_path, os.R_OK) and os.access(names_path, os.R_OK)):
+        return None, None
+    with open(names_path) as f:
+        names = [line.rstrip("\n") for line in f]
+    return names, np.load(cached_path, mmap_mode='r')
+
+
+def new_distance_matrix(mash_sketch_file, n, allow_caching=True):
+    """
+    Allocates an n x n distance matrix, with zeros on the diagonal and infinity everywhere else.
+    If `allow_caching` is set, it is built inside a temporary .npy file, so that a partially built
+    matrix is never mistaken for a cache; `save_distance_matrix()` then puts it in place.
+    """
+    if allow_caching:
+        partial_path = distance_matrix_paths(mash_sketch_file)[0] + ".partial.npy"
+        distances = np.lib.format.open_memmap(partial_path, mode='w+', dtype=DISTANCE_DTYPE, 
+                shape=(n, n))
+    else:
+        distances = np.empty((n, n), dtype=DISTANCE_DTYPE)
+    distances[:] = np.inf
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+def save_distance_matrix(mash_sketch_file, fasta_list, distances):
+    """
+    Finishes a matrix allocated by `new_distance_matrix()` as the cache for `mash_sketch_file`,
+    and returns it memory-mapped from its final location.
+    """
+    cached_path, names_path = distance_matrix_paths(mash_sketch_file)
+    distances.flush()
+    partial_path = distances.filename
+    del distances
+    with open(names_path, 'w') as f:
+        f.write("".join(fasta + "\n" for fasta in fasta_list))
+    os.rename(partial_path, cached_path)
+    return np.load(cached_path, mmap_mode='r')
+
+
+def sorted_edges(distances, max_diameter=DEFAULT_MAX_DIAMETER, block_size=EDGE_BLOCK_SIZE):
+    """
+    Finds all edges in the `distances` matrix that are no longer than `max_diameter`. Longer edges
+    could never be merged into a cluster, so they are dropped.
     
-    new_diameter = max([distances[(pair[0], pair[1])] for pair in permutations(cluster, 2)])
-    if have_cache: diameter_cache[tuple(sorted(cluster))] = new_diameter
-    return new_diameter
+    Returns three arrays (first, second, dist) of edges, sorted from shortest to longest. Each pair
+    of nodes is listed once, as (reference, query) from the first `mash dist` that reported it; 
+    ties are kept in that same order.
+    """
+    firsts, seconds, dists = [], [], []
+    for start in range(0, distances.shape[0], block_size):
+        # Rows of `block` are queries, and columns are references
+        block = np.asarray(distances[start:start + block_size])
+        # Pairs that `mash dist` never reported are left at infinity and never become edges
+        query, ref = np.nonzero(block <= min(max_diameter, np.finfo(block.dtype).max))
+        keep = ref > query + start
+        query, ref = query[keep], ref[keep]
+        firsts.append(ref.astype(np.int32))
+        seconds.append((query + start).astype(np.int32))
+        dists.append(block[query, ref])
+    firsts, seconds, dists = np.concatenate(firsts), np.concatenate(seconds), np.concatenate(dists)
+    order = np.argsort(dists, kind='mergesort')
+    return firsts[order], seconds[order], dists[order]
+
+
+def parse_mash_dist_row(line, num_refs, dtype=DISTANCE_DTYPE):
+    """
+    Parses one row of `mash dist -t` output into the query name and an array of its distances.
+    Fields for distances that didn't meet mash's p-value threshold are blank, and become infinity.
+    """
+    query, fields = line.rstrip("\n").split("\t", 1)
+    row = np.fromstring(fields, dtype=dtype, sep="\t")
+    if len(row) != num_refs:
+        row = np.array([float(field) if field else np.inf for field in fields.split("\t")], 
+                dtype=dtype)
+    return query, row
+
+
+def mash_dist_table(mash_sketch_file, queries, node_index, path_to_mash='mash', threads=1,
+        dtype=DISTANCE_DTYPE):
+    """
+    Runs `mash dist -t` of every sequence in `queries` (FASTA or .msh files) against the sketch,
+    using `threads` parallel threads within mash, and parses its table output in bulk into arrays
+    of `dtype`.
+    
+    Yields (query index, row) for each query, where `row` holds distances to every reference, 
+    reordered into the same positions as `node_index`, a dict of node names to indices.
+    """
+    args = [path_to_mash, 'dist', '-t', '-p', str(threads), mash_sketch_file] + list(queries)
+    process = subprocess.Popen(args, **SUBPROCESS_KWARGS)
+    header = process.stdout.readline().rstrip("\n").split("\t")
+    if len(header) < 2 or header[0] != '#query':
+        raise RuntimeError("Unexpected output from `%s`: %s" % (" ".join(args), process.stderr.read()))
+    refs = header[1:]
+    ref_order = np.empty(len(node_index), dtype=np.intp)
+    ref_order[[node_index[ref] for ref in refs]] = np.arange(len(refs))
+    for line in process.stdout:
+        query, row = parse_mash_dist_row(line, len(refs), dtype)
+        yield node_index[query], row[ref_order]
+    if process.wait() != 0:
+        raise RuntimeError("`%s` failed: %s" % (" ".join(args), process.stderr.read()))
 
 
 def mash_distances_edges(mash_sketch_file, fasta_list, max_diameter=DEFAULT_MAX_DIAMETER, 
-        path_to_mash='mash', allow_caching=True):
+        path_to_mash='mash', allow_caching=True, threads=None):
     """Calculates sketched Mash distances between all fastas in `fasta_list`.
     
-    Returns a hash of all distances indexed by (from, to) tuples, and a list of the edges
-    that are below `max_diameter`, consisting of (from, to, dist) tuples and sorted from 
-    shortest to longest."""
-    edges = []
-    distances = {}
-    cached_path = mash_sketch_file + ".distances_edges"
+    Returns a square matrix of all distances, indexed by [query, reference] positions within 
+    `fasta_list`, and the edges that are below `max_diameter` (see `sorted_edges()`).
+    
+    If `threads` is set, the sketch is compared against itself in one all-vs-all `mash dist` run 
+    using that many threads, instead of re-sketching each fasta in its own `mash dist` run.
+    
+    If `allow_caching` is set, the matrix is built within, and later memory-mapped from, an .npy 
+    file next to `mash_sketch_file`."""
+    cached_path = distance_matrix_paths(mash_sketch_file)[0]
     
     if (os.access(cached_path, os.R_OK) and os.access(mash_sketch_file, os.R_OK) and
             os.path.getmtime(cached_path) > os.path.getmtime(mash_sketch_file) and allow_caching):
-        sys.stderr.write("Loading cached Mash distances & edges from %s\n" % cached_path)
-        with open(cached_path, 'rb') as f:
-            return pickle.load(f)
-
-    for fasta in tqdm(fasta_list, desc="Calculating Mash distance matrix"):
-        if not os.path.isfile(fasta) or not os.access(fasta, os.R_OK):
-            raise RuntimeError("File {} doesn't exist or isn't readable".format(fasta))
-        process = subprocess.Popen([path_to_mash, 'dist', mash_sketch_file, fasta], 
-                **SUBPROCESS_KWARGS)
-        for line in process.stdout:
-            fasta_a, fasta_b, dist = line.split()[:3]
-            if fasta_a == fasta_b: continue
-            dist = float(dist)
-            distances[(fasta_a, fasta_b)] = dist
-            edges.append((fasta_a, fasta_b, dist))
-                
-    edges.sort(key=lambda edge: edge[2])
+        names, distances = load_distance_matrix(mash_sketch_file)
+        if names == fasta_list:
+            sys.stderr.write("Loading cached Mash distances from %s\n" % cached_path)
+            return distances, sorted_edges(distances, max_diameter)
+    
+    n = len(fasta_list)
+    node_index = dict((fasta, i) for i, fasta in enumerate(fasta_list))
+    distances = new_distance_matrix(mash_sketch_file, n, allow_caching)
+
+    if threads is not None:
+        rows = mash_dist_table(mash_sketch_file, [mash_sketch_file], node_index, path_to_mash, threads)
+        for query, row in tqdm(rows, total=n, desc="Calculating Mash distance matrix"):
+            distances[query] = row
+        np.fill_diagonal(distances, 0)
+    else:
+        for fasta in tqdm(fasta_list, desc="Calculating Mash distance matrix"):
+            if not os.path.isfile(fasta) or not os.access(fasta, os.R_OK):
+                raise RuntimeError("File {} doesn't exist or isn't readable".format(fasta))
+            process = subprocess.Popen([path_to_mash, 'dist', mash_sketch_file, fasta], 
+                    **SUBPROCESS_KWARGS)
+            for line in process.stdout:
+                fasta_a, fasta_b, dist = line.split()[:3]
+                if fasta_a == fasta_b: continue
+                distances[node_index[fasta_b], node_index[fasta_a]] = float(dist)
     
     if allow_caching:
-        with open(cached_path, 'wb') as f:
-            pickle.dump((distances, edges), f)
+        distances = save_distance_matrix(mash_sketch_file, fasta_list, distances)
             
-    return distances, edges
+    return distances, sorted_edges(distances, max_diameter)
 
 
-def mash_clusters(mash_sketch_file, fasta_list, distances, edges, max_diameter=DEFAULT_MAX_DIAMETER, 
-        greedy=True, max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE, path_to_mash='mash'):
+def incremental_mash_distances_edges(mash_sketch_file, fasta_list, prev_fasta_list, prev_distances,
+        max_diameter=DEFAULT_MAX_DIAMETER, path_to_mash='mash', allow_caching=True, threads=None):
+    """
+    Same as `mash_distances_edges()`, but copies distances among the fastas in `prev_fasta_list` 
+    from `prev_distances`, a matrix from a previous run, and only runs `mash dist` for the new 
+    fastas against the sketch. Every fasta in `prev_fasta_list` must still be in `fasta_list`.
+    """
+    n = len(fasta_list)
+    node_index = dict((fasta, i) for i, fasta in enumerate(fasta_list))
+    distances = new_distance_matrix(mash_sketch_file, n, allow_caching)
     
-    nodes = set(fasta_list)
-    clusters = []
-    cache = {}
+    prev_nodes = np.array([node_index[fasta] for fasta in prev_fasta_list], dtype=np.intp)
+    for start in range(0, len(prev_nodes), EDGE_BLOCK_SIZE):
+        rows = prev_nodes[start:start + EDGE_BLOCK_SIZE]
+        distances[np.ix_(rows, prev_nodes)] = prev_distances[start:start + EDGE_BLOCK_SIZE]
+    
+    prev_fastas = set(prev_fasta_list)
+    new_fastas = [fasta for fasta in fasta_list if fasta not in prev_fastas]
+    if len(new_fastas) > 0:
+        rows = mash_dist_table(mash_sketch_file, new_fastas, node_index, path_to_mash, threads or 1)
+        for query, row in tqdm(rows, total=len(new_fastas), desc="Calculating new Mash distances"):
+            # Mash distances are symmetric, so the new column is filled in along with the new row
+            distances[query] = row
+            distances[:, query] = row
+        np.fill_diagonal(distances, 0)
+    
+    if allow_caching:
+        distances = save_distance_matrix(mash_sketch_file, fasta_list, distances)
+    
+    return distances, sorted_edges(distances, max_diameter)
+
+
+def merge_edges(forest, edges, max_diameter=DEFAULT_MAX_DIAMETER, greedy=True, 
+        max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE, allow_merge=None):
+    """
+    Starting from the shortest of `edges`, merges the nodes at either end into clusters within
+    `forest`, unless that would exceed `max_cluster_size` or `max_diameter`. If `greedy` is False, 
+    stops at the first merge that would exceed a limit.
+    
+    If given, `allow_merge` is called with two roots before adding to an existing cluster, and 
+    returning False rejects that merge. Unlike exceeding a limit, this never stops a non-greedy 
+    merge, since it says nothing about the edges after it: in incremental mode, a new fasta that
+    would bridge two previous clusters shouldn't keep the other new fastas from being added.
+    """
+    firsts, seconds, dists = edges
+    edges = zip(firsts.tolist(), seconds.tolist(), dists.tolist())
     
-    # Starting from the smallest length edges, start merging nodes into clusters
     for edge in tqdm(edges, desc="Constructing clusters"):
-        first_already_in = find_node_in_clusters(edge[0], clusters)
-        second_already_in = find_node_in_clusters(edge[1], clusters)
-        if first_already_in is not None:
-            if second_already_in is not None:
-                if first_already_in == second_already_in: continue
-                new_clust_size = len(clusters[first_already_in]) + len(clusters[second_already_in])
-                new_diameter = diameter(clusters[first_already_in], distances, 
-                        clusters[second_already_in], cache)
-                if new_clust_size > max_cluster_size or new_diameter > max_diameter: 
-                    if greedy: continue
-                    else: break
-                clusters[first_already_in].extend(clusters[second_already_in])
-                del clusters[second_already_in]
-            else:
-                if (len(clusters[first_already_in]) >= max_cluster_size or diameter(
-                        clusters[first_already_in], distances, [edge[1]], cache) > max_diameter):
-                    if greedy: continue
-                    else: break
-                clusters[first_already_in].append(edge[1])
-        elif second_already_in is not None:
-            if (len(clusters[second_already_in]) >= max_cluster_size or diameter(
-                    clusters[second_already_in], distances, [edge[0]], cache) > max_diameter):
-                if greedy: continue
-                else: break
-            clusters[second_already_in].append(edge[0])
+        first = forest.find(edge[0])
+        second = forest.find(edge[1])
+        if first == second: continue
+        if not forest.in_cluster(first):
+            if not forest.in_cluster(second):
+                if edge[2] > max_diameter: continue
+                forest.union(first, second, forest.merged_diameter(first, second))
+                continue
+            # A single node is always added onto the end of an existing cluster
+            first, second = second, first
+        if forest.in_cluster(second):
+            too_big = forest.size[first] + forest.size[second] > max_cluster_size
         else:
-            if edge[2] > max_diameter: continue
-            clusters.append([edge[0], edge[1]])
+            too_big = forest.size[first] >= max_cluster_size
+        new_diameter = None
+        if not too_big:
+            if allow_merge is not None and not allow_merge(first, second): continue
+            new_diameter = forest.merged_diameter(first, second)
+        if new_diameter is None or new_diameter > max_diameter:
+            if greedy: continue
+            else: break
+        forest.union(first, second, new_diameter)
+
+
+def mash_clusters(mash_sketch_file, fasta_list, distances, edges, max_diameter=DEFAULT_MAX_DIAMETER, 
+        greedy=True, max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE, path_to_mash='mash'):
+    
+    forest = ClusterForest(distances)
+    merge_edges(forest, edges, max_diameter, greedy, max_cluster_size)
 
     # Reverse-sort clusters by size, then append the unclustered nodes as single-node clusters
+    clusters = [[fasta_list[node] for node in cluster] for cluster in forest.clusters()]
     clusters.sort(key=lambda cluster: len(cluster), reverse=True)
     flattened = list(chain.from_iterable(clusters))
-    unclustered = nodes - set(flattened)
+    unclustered = set(fasta_list) - set(flattened)
     clusters.extend([[node] for node in unclustered])
     return clusters
 
 
+def incremental_mash_clusters(fasta_list, distances, edges, prev_clusters, 
+        max_diameter=DEFAULT_MAX_DIAMETER, greedy=True, max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE):
+    """
+    Adds the fastas that aren't yet in `prev_clusters`, which were read from a previous run's 
+    output, to those clusters or to new ones, following the same rules as `mash_clusters()`.
+    Only edges that touch a new fasta are considered, and two previous clusters are never merged,
+    so every previous cluster keeps its position in the output and its members stay in order. 
+    New clusters follow, sorted by size, and then any new unclustered fastas.
+    
+    Returns the clusters, and a list of positions of the clusters that are new or have changed.
+    """
+    node_index = dict((fasta, i) for i, fasta in enumerate(fasta_list))
+    forest = ClusterForest(distances)
+    prev_positions = []
+    for position, cluster in enumerate(prev_clusters):
+        nodes = [node_index[fasta] for fasta in cluster]
+        root = nodes[0]
+        for node in nodes[1:]:
+            root = forest.union(root, node, 0)
+        forest.diameter[root] = diameter(nodes, distances)
+        prev_positions.append((nodes[0], position))
+    
+    is_new = np.ones(len(fasta_list), dtype=bool)
+    is_new[[node_index[fasta] for fasta in chain.from_iterable(prev_clusters)]] = False
+    
+    def allow_merge(first, second):
+        return is_new[forest.members(first)].all() or is_new[forest.members(second)].all()
+    
+    firsts, seconds, dists = edges
+    touches_new = is_new[firsts] | is_new[seconds]
+    
+    merge_edges(forest, (firsts[touches_new], seconds[touches_new], dists[touches_new]), 
+            max_diameter, greedy, max_cluster_size, allow_merge)
+    # Roots move as clusters are merged, so previous clusters are found again by their first member
+    prev_position = dict((forest.find(node), position) for node, position in prev_positions)
+    
+    clusters = [list(cluster) for cluster in prev_clusters]
+    changed = []
+    new_clusters = []
+    for members in forest.clusters():
+        root = forest.find(members[0])
+        new_fastas = [fasta_list[node] for node in members if is_new[node]]
+        if root in prev_position:
+            if len(new_fastas) > 0:
+                clusters[prev_position[root]].extend(new_fastas)
+                changed.append(prev_position[root])
+        else:
+            new_clusters.append(new_fastas)
+    
+    new_clusters.sort(key=lambda cluster: len(cluster), reverse=True)
+    flattened = set(chain.from_iterable(clusters + new_clusters))
+    unclustered = set(fasta_list) - flattened
+    new_clusters.extend([[node] for node in unclustered])
+    changed = sorted(changed) + list(range(len(clusters), len(clusters) + len(new_clusters)))
+    return clusters + new_clusters, changed
+
+
+def read_clusters(filename):
+    """Reads clusters previously saved by `write_clusters()`."""
+    with open(filename) as f:
+        return [line.rstrip("\n").split("\t") for line in f if line.strip() != ""]
+
+
 def write_clusters(clusters, filename=None):
     f = open(filename, "w") if filename else sys.stdout
     for cluster in clusters:
@@ -157,10 +447,11 @@ def write_clusters(clusters, filename=None):
     f.close()
 
 
-def write_cluster_diameters(clusters, distances, filename=None):
+def write_cluster_diameters(clusters, fasta_list, distances, filename=None):
     f = open(filename, "w") if filename else sys.stderr
+    node_index = dict((fasta, i) for i, fasta in enumerate(fasta_list))
     for cluster in clusters:
-        f.write(str(diameter(cluster, distances)) + "\n")
+        f.write(str(diameter([node_index[node] for node in cluster], distances)) + "\n")
     f.close()
 
 
@@ -176,8 +467,16 @@ if __name__ == "__main__":
             help="Path to the mash executable")
     parser.add_argument("-G", "--not_greedy", dest='greedy', default=True, action='store_false', 
             help="Don't add to smaller clusters after one cluster reaches the size/diameter limit")
+    parser.add_argument("-t", "--threads", type=int, default=None,
+            help="Compare the sketch against itself in one `mash dist` run with this many threads, " +
+                 "instead of running `mash dist` separately for each fasta.")
     parser.add_argument("-C", "--no_edges_cache", dest='edges_cache', default=True, action='store_false', 
-            help="Don't cache or reuse any Mash distances & edges, saved in a .distances_edges file")
+            help="Don't cache or reuse any Mash distances, saved in a .distances.npy file")
+    parser.add_argument("-i", "--incremental", default=False, action='store_true',
+            help="Reuse the cached Mash distances and the clusters in --output from a previous run, " +
+                 "only calculating distances for new fastas and adding them to those clusters.")
+    parser.add_argument("-c", "--output_changed", default=None,
+            help="Outputs the (0-based) line numbers of new or changed clusters to this file if set.")
     parser.add_argument("-m", "--max_cluster_diameter", type=float, default=DEFAULT_MAX_DIAMETER, 
             help="Maximum diameter of a cluster in Mash units. For no limit, set to 0. " + 
                  ("Default is: %f" % DEFAULT_MAX_DIAMETER))
@@ -198,15 +497,41 @@ if __name__ == "__main__":
     
     fasta_list = get_fasta_list(args.mash_sketch_file, path_to_mash=args.path_to_mash)
     
-    distances, edges = mash_distances_edges(args.mash_sketch_file, fasta_list, 
-            max_diameter=args.max_cluster_diameter, path_to_mash=args.path_to_mash, 
-            allow_caching=args.edges_cache)
+    prev_clusters = None
+    if args.incremental:
+        if args.output is None:
+            parser.error("--incremental requires the previous clusters to be in --output.")
+        prev_fasta_list, prev_distances = load_distance_matrix(args.mash_sketch_file)
+        if os.access(args.output, os.R_OK): prev_clusters = read_clusters(args.output)
+        if (prev_fasta_list is None or prev_clusters is None or 
+                sorted(chain.from_iterable(prev_clusters)) != sorted(prev_fasta_list) or
+                not set(prev_fasta_list).issubset(fasta_list)):
+            sys.stderr.write("WARN: Can't reuse the previous Mash distances and clusters; " +
+                    "clustering from scratch\n")
+            prev_clusters = None
     
-    clusters = mash_clusters(args.mash_sketch_file, fasta_list, distances, edges, 
-            max_diameter=args.max_cluster_diameter, max_cluster_size=args.max_cluster_size, 
-            path_to_mash=args.path_to_mash, greedy=args.greedy)
+    if prev_clusters is not None:
+        distances, edges = incremental_mash_distances_edges(args.mash_sketch_file, fasta_list, 
+                prev_fasta_list, prev_distances, max_diameter=args.max_cluster_diameter, 
+                path_to_mash=args.path_to_mash, allow_caching=args.edges_cache, threads=args.threads)
+        clusters, changed = incremental_mash_clusters(fasta_list, distances, edges, prev_clusters,
+                max_diameter=args.max_cluster_diameter, max_cluster_size=args.max_cluster_size, 
+                greedy=args.greedy)
+    else:
+        distances, edges = mash_distances_edges(args.mash_sketch_file, fasta_list, 
+                max_diameter=args.max_cluster_diameter, path_to_mash=args.path_to_mash, 
+                allow_caching=args.edges_cache, threads=args.threads)
+        clusters = mash_clusters(args.mash_sketch_file, fasta_list, distances, edges, 
+                max_diameter=args.max_cluster_diameter, max_cluster_size=args.max_cluster_size, 
+                path_to_mash=args.path_to_mash, greedy=args.greedy)
+        changed = list(range(len(clusters)))
     
     write_clusters(clusters, args.output)
+    sys.stderr.write("INFO: %d of %d clusters are new or changed\n" % (len(changed), len(clusters)))
+    
+    if args.output_changed is not None:
+        with open(args.output_changed, "w") as f:
+            f.write("".join("%d\n" % position for position in changed))
     
     if args.output_diameters is not None:
-        write_cluster_diameters(clusters, distances, args.output_diameters)
+        write_cluster_diameters(clusters, fasta_list, distances, args.output_diameters)
@@ -8,11 +8,16 @@ USAGE: python parsnp2table.py parsnp.vcf output.tsv [regex]
 """
 
 import sys
-from tqdm import tqdm
+import os
+import shutil
+import tempfile
+import argparse
 import numpy as np
 import re
 
 from pylib.parsnp_vcf import load_parsnp_vcf
+from pylib.packed_genotypes import pack_genotypes
+from pylib.snv_distances import snv_distances, write_distance_tsv
 
 # Note, as per https://harvest.readthedocs.io/en/latest/content/parsnp/quickstart.html
 # "harvest-tools VCF outputs indels in non standard format.
@@ -20,25 +25,38 @@ from pylib.parsnp_vcf import load_parsnp_vcf
 #  Excluding indel rows (default behavior) converts file into valid VCF format.
 #  this will be updated in future version"
 
-if len(sys.argv) < 3:
-    print __doc__
-    sys.exit(1)
-
-seq_list, vcf_mat, _ = load_parsnp_vcf(sys.argv[1], progress=True)
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('vcf', metavar='PARSNP_VCF', help='Path to the parsnp.vcf file')
+parser.add_argument('output', metavar='OUTPUT_TSV', help='Path for the .tsv of SNV distances')
+parser.add_argument('regex', metavar='REGEX', nargs='?', default=None,
+        help='A python regex, that if given, will be scrubbed out of genome names.')
+parser.add_argument("-m", "--mmap_dir", default=None,
+        help="If given, alleles are streamed into a temporary memory-mapped file within this " +
+        "directory instead of being held in memory.")
+parser.add_argument("-b", "--backend", choices=('int16', 'packed'), default='int16',
+        help="How distances are calculated: by comparing rows of int16 alleles (the default), or " +
+        "by popcounts over genotypes packed into one bit-plane per non-reference allele.")
+parser.add_argument("-w", "--workers", type=int, default=1,
+        help="Number of processes to calculate distances with; default=1")
+args = parser.parse_args()
+
+tmp_dir = args.mmap_dir and tempfile.mkdtemp(dir=args.mmap_dir)
+mmap_path = tmp_dir and os.path.join(tmp_dir, 'vcf_mat.npy')
+seq_list, vcf_mat, _ = load_parsnp_vcf(args.vcf, progress=True, mmap_path=mmap_path)
 clean_seq_list = seq_list
-if len(sys.argv) >= 4:
-    clean_seq_list = map(lambda seq: re.sub(sys.argv[3], '', seq), seq_list)
-
-# Create the distance matrix. `np.count_nonzero` quickly counts nonzero elements in an np.array
-dist_mat = np.zeros((len(seq_list), len(seq_list)))
-for i, seq1 in tqdm(enumerate(seq_list), total=len(seq_list), desc="Calculating SNV distances"):
-    for j, seq2 in enumerate(seq_list):
-        dist_mat[i, j] = np.count_nonzero(vcf_mat[i, :] - vcf_mat[j, :])
-
-# Open the output TSV file and dump the distance 
-with open(sys.argv[2], 'w') as out:
-    out.write('strains\t' + '\t'.join(clean_seq_list) + '\n')
-    for i, seq1 in enumerate(clean_seq_list):
-        out.write(seq1 + '\t')
-        out.write('\t'.join(map(str, dist_mat[i, :])))
-        out.write('\n')
+if args.regex is not None:
+    clean_seq_list = map(lambda seq: re.sub(args.regex, '', seq), seq_list)
+
+# Create the distance matrix. Only the upper triangle is computed, in tiles; see pylib.snv_distances
+if args.backend == 'packed':
+    dist_mat = snv_distances(pack_genotypes(vcf_mat, progress=True), packed=True, progress=True,
+            workers=args.workers)
+else:
+    dist_mat = snv_distances(vcf_mat, progress=True, workers=args.workers)
+
+# Open the output TSV file and dump the distance
+write_distance_tsv(args.output, clean_seq_list, dist_mat)
+
+if tmp_dir is not None:
+    del vcf_mat
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Serves subsets of a .parsnp.vcfs.npz file (or .parsnp.vcfs.shards directory) over HTTP, so that
+visualizations don't have to load and subset the whole file for every request. Arrays for each
+cluster are memory-mapped when first requested and kept in an LRU cache, along with the SNV
+distances computed for them, until the cache outgrows --budget_mb.
+
+If PATH is a directory, e.g. the pipeline's `out/` directory, the .parsnp.vcfs.npz or
+.parsnp.vcfs.shards with the latest YYYY-MM-DD date in its name is served, and the server switches
+to a newer one automatically once it appears. A file or shard directory given as PATH is reopened
+whenever it is replaced.
+
+All endpoints take GET requests and reply with JSON, or with an uncompressed .npz of the same
+arrays (readable with np.load) if `format=npz` is added to the query string.
+
+- /status => the path being served and the contents of the cache
+- /clusters => the genomes in each cluster
+- /genotypes?genomes=A,B,C => the alleles of genomes A, B, and C at sites where they differ.
+  Instead of `genomes`, `cluster=#` selects all genomes in that cluster. Add `chrom`, `start`, and
+  `end` to only include sites on that contig and within that range of positions (1-indexed and
+  inclusive, like POS in the VCF). Add `all_sites=1` to include sites where they don't differ.
+- /alleles?genomes=A,B,C => the allele info for the same sites, without the alleles
+- /distances?genomes=A,B,C => the pairwise SNV distances between the genomes, optionally counting
+  only sites within `chrom`, `start`, and `end`
+
+For example, after running `rake parsnp` on the example dataset:
+
+    $ python scripts/parsnp_npz_server.py out/ &
+    $ curl 'http://localhost:8990/clusters'
+    $ curl 'http://localhost:8990/distances?cluster=0'
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from cStringIO import StringIO
+from collections import OrderedDict
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from pylib.parsnp_npz import ParsnpNpz, SHARD_MANIFEST
+from pylib.snv_distances import snv_distances
+
+DEFAULT_PORT = 8990
+DEFAULT_BUDGET_MB = 2048
+DEFAULT_RELOAD_INTERVAL = 60
+DATED_NPZ_REGEX = r'\.(\d{4}-\d{2}-\d{2})\.parsnp\.vcfs\.(npz|shards)$'
+
+
+def latest_npz(path, prefix=None):
+    """
+    Returns `path` if it is a .npz file or shard directory. Otherwise, returns the .parsnp.vcfs.npz
+    or .parsnp.vcfs.shards in the directory `path` with the latest date in its name, optionally
+    only considering filenames starting with `prefix`; shard directories win ties.
+    """
+    if not os.path.isdir(path) or os.path.isfile(os.path.join(path, SHARD_MANIFEST)):
+        return path
+    candidates = []
+    for filename in os.listdir(path):
+        match = re.search(DATED_NPZ_REGEX, filename)
+        if match is None or (prefix is not None and not filename.startswith(prefix)):
+            continue
+        full_path = os.path.join(path, filename)
+        is_shards = match.group(2) == 'shards'
+        if is_shards and not os.path.isfile(os.path.join(full_path, SHARD_MANIFEST)):
+            continue
+        candidates.append((match.group(1), is_shards, full_path))
+    return max(candidates)[2] if len(candidates) > 0 else None
+
+
+def npz_signature(path):
+    """Changes whenever the .npz file or shard directory at `path` is replaced."""
+    if os.path.isdir(path):
+        path = os.path.join(path, SHARD_MANIFEST)
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+class ClusterCache(object):
+    """
+    Tracks which clusters of a ParsnpNpz have arrays loaded, along with distance matrices computed
+    for them, and releases the least recently used clusters when the total exceeds `budget_bytes`.
+    """
+
+    def __init__(self, npz, budget_bytes):
+        self.npz = npz
+        self.budget_bytes = budget_bytes
+        self.distances = {}
+        self._clusters = OrderedDict()
+
+    def cluster_nbytes(self, cluster):
+        nbytes = self.npz.cluster_nbytes(cluster)
+        if cluster in self.distances:
+            nbytes += self.distances[cluster].nbytes
+        return nbytes
+
+    def touch(self, cluster):
+        """
+        Marks the `cluster` as most recently used, after a request for it has loaded what it needs,
+        and evicts other clusters until the cache fits within the budget again.
+        """
+        self._clusters.pop(cluster, None)
+        self._clusters[cluster] = self.cluster_nbytes(cluster)
+        total = sum(self._clusters.values())
+        while total > self.budget_bytes and len(self._clusters) > 1:
+            oldest, nbytes = self._clusters.popitem(last=False)
+            self.npz.release(oldest)
+            self.distances.pop(oldest, None)
+            total -= nbytes
+
+    def status(self):
+        return [{"cluster": cluster, "bytes": nbytes} for cluster, nbytes in
+                self._clusters.iteritems()]
+
+
+class ParsnpNpzServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTPServer that holds the ParsnpNpz currently being served and its ClusterCache. Requests
+    are handled in threads, but one at a time, since they share the cache.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, path, prefix=None, budget_bytes=DEFAULT_BUDGET_MB << 20,
+            reload_interval=DEFAULT_RELOAD_INTERVAL, quiet=False):
+        self.path = path
+        self.prefix = prefix
+        self.budget_bytes = budget_bytes
+        self.reload_interval = reload_interval
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.npz_path = None
+        self.npz_signature = None
+        self.cache = None
+        self.last_checked = None
+        self.reload()
+        if self.cache is None:
+            raise IOError("No .parsnp.vcfs.npz file or shard directory found at %s" % path)
+        HTTPServer.__init__(self, address, ParsnpNpzHandler)
+
+    def reload(self):
+        """Opens the latest .npz or shard directory at `self.path`, if it has changed."""
+        self.last_checked = time.time()
+        npz_path = latest_npz(self.path, self.prefix)
+        try:
+            signature = npz_signature(npz_path) if npz_path is not None else None
+            if signature is None or (npz_path, signature) == (self.npz_path, self.npz_signature):
+                return
+            npz = ParsnpNpz(npz_path)
+        except Exception as e:
+            # e.g., the file is still being written; keep serving the previous one
+            sys.stderr.write("WARN: Couldn't open %s: %s\n" % (npz_path, e))
+            return
+        if not self.quiet:
+            sys.stderr.write("INFO: Serving %s\n" % npz_path)
+        self.npz_path, self.npz_signature = npz_path, signature
+        self.cache = ClusterCache(npz, self.budget_bytes)
+
+    def current_cache(self):
+        if time.time() - self.last_checked >= self.reload_interval:
+            self.reload()
+        return self.cache
+
+
+def to_json(value):
+    """Converts arrays into lists; structured arrays become a dict of lists, one per field."""
+    if not isinstance(value, np.ndarray):
+        return value
+    if value.dtype.names is not None:
+        return dict((name, value[name].tolist()) for name in value.dtype.names)
+    return value.tolist()
+
+
+class ParsnpNpzHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).iteritems())
+        endpoint = getattr(self, 'get_' + url.path.strip('/'), None)
+        if endpoint is None:
+            return self.send_error(404, "Unknown endpoint %s" % url.path)
+        try:
+            with self.server.lock:
+                cache = self.server.current_cache()
+                response = endpoint(cache, params)
+        except KeyError as e:
+            return self.send_error(404, "Not found: %s" % e)
+        except ValueError as e:
+            return self.send_error(400, str(e))
+        self.send_arrays(response, params.get('format', 'json'))
+
+    def send_arrays(self, response, output_format):
+        if output_format == 'npz':
+            body = StringIO()
+            np.savez(body, **dict((key, np.asarray(value)) for key, value in response.iteritems()))
+            body = body.getvalue()
+            content_type = 'application/octet-stream'
+        elif output_format == 'json':
+            body = json.dumps(dict((key, to_json(value)) for key, value in response.iteritems()),
+                    separators=(',', ':'))
+            content_type = 'application/json'
+        else:
+            return self.send_error(400, "Unknown format %s" % output_format)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def genomes(self, npz, params):
+        """Returns the genomes requested by either the `genomes` or `cluster` parameter."""
+        if 'genomes' in params:
+            return [genome for genome in params['genomes'].split(',') if genome != '']
+        return npz.array(self.cluster(npz, params), 'seq_list').tolist()
+
+    def cluster(self, npz, params):
+        """Returns the cluster requested by the `cluster` parameter."""
+        if 'cluster' not in params:
+            raise ValueError("Either genomes or cluster must be given")
+        cluster = int(params['cluster'])
+        if cluster < 0 or cluster >= npz.num_clusters:
+            raise KeyError("cluster %d" % cluster)
+        return cluster
+
+    def subset(self, npz, params, polymorphic_only=True):
+        """
+        Subsets the npz for the requested genomes to the `chrom`, `start`, and `end` given. A
+        requested `cluster` is subset by its index, since genome names may repeat across clusters.
+        """
+        start, end = params.get('start'), params.get('end')
+        region = (params.get('chrom'), start and int(start), end and int(end), polymorphic_only)
+        if 'genomes' in params:
+            subset = npz.subset(self.genomes(npz, params), *region)
+        else:
+            subset = npz.cluster_subset(self.cluster(npz, params), None, *region)
+        return subset, subset.seq_list
+
+    def get_status(self, cache, params):
+        return {"path": self.server.npz_path, "budget_bytes": cache.budget_bytes,
+                "clusters": cache.status()}
+
+    def get_clusters(self, cache, params):
+        return {"clusters": [cache.npz.array(cluster, 'seq_list').tolist() for cluster in
+                range(cache.npz.num_clusters)]}
+
+    def get_genotypes(self, cache, params):
+        all_sites = params.get('all_sites', '0') not in ('', '0')
+        subset, genomes = self.subset(cache.npz, params, not all_sites)
+        cache.touch(subset.cluster)
+        return {"cluster": subset.cluster, "genomes": genomes, "sites": subset.sites,
+                "vcf_mat": subset.vcf_mat, "allele_info": subset.allele_info}
+
+    def get_alleles(self, cache, params):
+        response = self.get_genotypes(cache, params)
+        del response["vcf_mat"]
+        return response
+
+    def get_distances(self, cache, params):
+        npz = cache.npz
+        if not any(key in params for key in ('chrom', 'start', 'end')):
+            # Distances over all sites are computed once for the whole cluster, then indexed
+            genomes = self.genomes(npz, params)
+            if 'genomes' in params:
+                cluster, rows = npz.cluster_rows(genomes)
+            else:
+                cluster, rows = self.cluster(npz, params), np.arange(len(genomes))
+            if cluster not in cache.distances:
+                if npz.has_array(cluster, 'vcf_bits'):
+                    dist_mat = snv_distances(npz.array(cluster, 'vcf_bits'), packed=True)
+                else:
+                    dist_mat = snv_distances(npz.array(cluster, 'vcf_mat'))
+                cache.distances[cluster] = dist_mat
+            dist_mat = cache.distances[cluster][np.ix_(rows, rows)]
+        else:
+            subset, genomes = self.subset(npz, params)
+            cluster = subset.cluster
+            dist_mat = snv_distances(subset.vcf_mat)
+        cache.touch(cluster)
+        return {"cluster": cluster, "genomes": genomes, "distances": dist_mat}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', metavar='PATH',
+            help='A .parsnp.vcfs.npz file, a .parsnp.vcfs.shards directory, or a directory ' +
+            'containing dated .parsnp.vcfs.npz files or shards, from which the latest is served')
+    parser.add_argument("-x", "--prefix", default=None,
+            help="If PATH is a directory, only serve files whose names start with this prefix")
+    parser.add_argument("-H", "--host", default="127.0.0.1",
+            help="Address to listen on; default=127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT,
+            help="Port to listen on; default=%d" % DEFAULT_PORT)
+    parser.add_argument("-b", "--budget_mb", type=int, default=DEFAULT_BUDGET_MB,
+            help="Memory budget, in MB, for clusters kept in the cache; default=%d" %
+            DEFAULT_BUDGET_MB)
+    parser.add_argument("-r", "--reload_interval", type=int, default=DEFAULT_RELOAD_INTERVAL,
+            help="Seconds between checks for a newer .npz file; default=%d" %
+            DEFAULT_RELOAD_INTERVAL)
+    parser.add_argument("-q", "--quiet", default=False, action='store_true',
+            help="Don't log requests.")
+    args = parser.parse_args()
+
+    try:
+        server = ParsnpNpzServer((args.host, args.port), args.path, args.prefix,
+                args.budget_mb << 20, args.reload_interval, args.quiet)
+    except IOError as e:
+        sys.stderr.write("FATAL: %s\n" % e)
+        sys.exit(1)
+    if not args.quiet:
+        sys.stderr.write("INFO: Listening on http://%s:%d/\n" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
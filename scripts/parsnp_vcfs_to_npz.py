@@ -4,61 +4,145 @@ Creates an .npz file with NumPy arrays extracted from a series of parsnp.vcf fil
 the data as NumPy arrays allows for fast loading and subsetting, e.g. by pathogendb-viz pages.
 
 For each parsnp.vcf file, the .npz will contain three or four arrays (# is an integer index):
-- 'vcf_mat_#' => A two-dimensional int16 array (.shape = (A, B)) of the allele calls
+- 'vcf_mat_#' => A two-dimensional int16 array (.shape = (A, B)) of the allele calls.
+   **If `--packed_genotypes` is used,** it is replaced by 'vcf_bits_#', a three-dimensional 
+   uint8 array of the same allele calls packed into one bit-plane per non-reference allele; 
+   see `pylib.packed_genotypes.unpack_genotypes()` to unpack it.
 - 'vcf_allele_info_#' => A one-dimensional <str, uint64, str> array (.size = B) that contains 
    the allele info from the leftmost VCF columns, specifically CHROM, POS, and ALT. 
    **If `--fastas` is provided,** the .fasta and .bed for the reference are consulted to add 
    more columns: <str, uint64, uint64, str, str> for gene, nt_pos, aa_pos, aa_alt, and desc.
    `--sequin_annotations` may be used to look for .features_table.txt annotations instead.
+   **If `--encode_strings` is also used,** the gene and desc columns are uint32 indices into 
+   'gene_table_#' and 'desc_table_#', which are sorted str arrays of their unique values; see
+   `pylib.parsnp_vcf.decode_allele_info()` to decode them.
 - 'seq_list_#' => A one-dimensional str array (.size = A) of the sequence names
 - 'ref_chrom_sizes_#' => **If `--fastas` is provided,** this is a one-dimensional 
    <str, uint64> array of contig names and sizes for the reference .fasta file.
+
+**If `--shard_dir` is provided,** the same arrays are also saved as uncompressed .npy files that
+can be memory-mapped, with one subdirectory (or shard) per parsnp.vcf file, named by its index; 
+e.g., 'vcf_mat_#' is saved as '#/vcf_mat.npy'. A 'manifest.json' file in that directory lists 
+the arrays in each shard, and maps each genome name to its cluster, shard, and row in 'vcf_mat'.
+
+Instead of a parsnp.vcf file, the .segment.npz that process_parsnp_vcf.py saved alongside it may be
+given, which holds the same arrays as read from the parsnp.vcf, so it isn't parsed again.
 """
 
 import sys
+import os
+import json
+import shutil
+import multiprocessing
+import tempfile
 from os import access, R_OK
-from os.path import splitext, basename, isfile
+from os.path import splitext, basename, dirname, isdir, isfile, join
 from tqdm import tqdm
 import numpy as np
 import re
 import argparse
 
-from pylib.parsnp_vcf import load_parsnp_vcf, enhance_allele_info, fasta_chrom_sizes
+from pylib.parsnp_vcf import (load_parsnp_vcf, enhance_allele_info, encode_allele_info,
+        fasta_chrom_sizes)
+from pylib.packed_genotypes import pack_genotypes
+from pylib.parsnp_npz import SHARD_MANIFEST, SEGMENT_EXTENSION, load_segment, save_npz_atomically
 
 BED_EXTENSION = '.bed'
 SEQUIN_EXTENSION = '.features_table.txt'
 DEFAULT_GENETIC_CODE = 11
 
 
-def read_vcfs(parsnp_vcfs, in_paths=None, sequin_format=False, transl_table=DEFAULT_GENETIC_CODE, 
-        clean_names=None, quiet=False):
+def read_vcf(i, vcf_file, in_paths=None, sequin_format=False, transl_table=DEFAULT_GENETIC_CODE,
+        clean_names=None, quiet=False, mmap_dir=None, packed=False, annot_cache_dir=None, 
+        encode_strings=False, progress=True):
+    """
+    Reads the `i`th parsnp.vcf file, returning a dictionary of its arrays, named as in the .npz.
+    If `progress` is False, progress bars are hidden, but unlike `quiet`, warnings are still shown.
+    """
     vcf_data = {}
-    opts = {"progress": not quiet}
+    opts = {"progress": progress and not quiet}
     annots_ext = SEQUIN_EXTENSION if sequin_format else BED_EXTENSION
     
+    if vcf_file.endswith(SEGMENT_EXTENSION):
+        # Segments saved by process_parsnp_vcf.py hold the arrays already read from the parsnp.vcf
+        seq_list, vcf_mat, vcf_allele_info = load_segment(vcf_file)
+    else:
+        mmap_path = join(mmap_dir, 'vcf_mat_%d.npy' % i) if mmap_dir is not None else None
+        seq_list, vcf_mat, vcf_allele_info = load_parsnp_vcf(vcf_file, mmap_path=mmap_path, **opts)
+    clean_seq_list = seq_list
+    if clean_names is not None and len(clean_names) > 0:
+        clean_seq_list = map(lambda seq: re.sub(clean_names, '', seq), seq_list)
+    vcf_data['seq_list_%d' % i] = np.array(clean_seq_list)
+    if packed:
+        vcf_data['vcf_bits_%d' % i] = pack_genotypes(vcf_mat, **opts)
+        del vcf_mat
+    else:
+        vcf_data['vcf_mat_%d' % i] = vcf_mat
+    if in_paths is not None:
+        ref_seq = seq_list[0]
+        ref_fasta = next((x for x in in_paths if splitext(basename(x))[0] == ref_seq), None)
+        ref_annots = re.sub(r'\.fa(sta)?$', annots_ext, ref_fasta)
+        if (isfile(ref_fasta) and access(ref_fasta, R_OK) and 
+                isfile(ref_annots) and access(ref_annots, R_OK)):
+            vcf_allele_info = enhance_allele_info(vcf_allele_info, ref_fasta, ref_annots, 
+                    sequin_format, transl_table, cache_dir=annot_cache_dir, **opts)
+            vcf_data['ref_chrom_sizes_%d' % i] = fasta_chrom_sizes(ref_fasta, annot_cache_dir)
+            if encode_strings:
+                vcf_allele_info, tables = encode_allele_info(vcf_allele_info)
+                for name, table in tables.iteritems():
+                    vcf_data['%s_table_%d' % (name, i)] = table
+        elif not quiet:
+            sys.stderr.write("WARN: Couldn't find .fasta + %s annotations for %s\n" % 
+                    (annots_ext, ref_seq))
+    vcf_data['vcf_allele_info_%d' % i] = vcf_allele_info
+    
+    return vcf_data
+
+
+def _read_vcf_job(args):
+    vcf_data = read_vcf(*args)
+    # Alleles streamed into a memory-mapped file (or mapped from a segment) are reopened from it by
+    # the parent process, rather than being pickled back to it
+    for key, value in vcf_data.items():
+        if isinstance(value, np.memmap) and value.filename is not None:
+            order = 'F' if value.flags.f_contiguous and not value.flags.c_contiguous else 'C'
+            vcf_data[key] = (value.filename, value.offset, value.dtype.str, value.shape, order)
+    return vcf_data
+
+
+def read_vcfs(parsnp_vcfs, in_paths=None, sequin_format=False, transl_table=DEFAULT_GENETIC_CODE, 
+        clean_names=None, quiet=False, mmap_dir=None, packed=False, annot_cache_dir=None, 
+        encode_strings=False, jobs=1):
+    vcf_data = {}
+    
     if not quiet:
         sys.stderr.write("INFO: %d VCF files will be processed.\n" % len(parsnp_vcfs))
     
-    for i, vcf_file in enumerate(parsnp_vcfs):
-        seq_list, vcf_mat, vcf_allele_info = load_parsnp_vcf(vcf_file, **opts)
-        clean_seq_list = seq_list
-        if clean_names is not None and len(clean_names) > 0:
-            clean_seq_list = map(lambda seq: re.sub(clean_names, '', seq), seq_list)
-        vcf_data['seq_list_%d' % i] = np.array(clean_seq_list)
-        vcf_data['vcf_mat_%d' % i] = vcf_mat
-        if in_paths is not None:
-            ref_seq = seq_list[0]
-            ref_fasta = next((x for x in in_paths if splitext(basename(x))[0] == ref_seq), None)
-            ref_annots = re.sub(r'\.fa(sta)?$', annots_ext, ref_fasta)
-            if (isfile(ref_fasta) and access(ref_fasta, R_OK) and 
-                    isfile(ref_annots) and access(ref_annots, R_OK)):
-                vcf_allele_info = enhance_allele_info(vcf_allele_info, ref_fasta, ref_annots, 
-                        sequin_format, transl_table, **opts)
-                vcf_data['ref_chrom_sizes_%d' % i] = fasta_chrom_sizes(ref_fasta)
-            elif not quiet:
-                sys.stderr.write("WARN: Couldn't find .fasta + %s annotations for %s\n" % 
-                        (annots_ext, ref_seq))
-        vcf_data['vcf_allele_info_%d' % i] = vcf_allele_info
+    if jobs <= 1:
+        for i, vcf_file in enumerate(parsnp_vcfs):
+            vcf_data.update(read_vcf(i, vcf_file, in_paths, sequin_format, transl_table, 
+                    clean_names, quiet, mmap_dir, packed, annot_cache_dir, encode_strings))
+        return vcf_data
+    
+    # With multiple jobs, VCFs are processed by a pool of workers, which don't show progress bars
+    # of their own; instead, there is one progress bar for all of the VCF files
+    pool = multiprocessing.Pool(jobs)
+    try:
+        tasks = [(i, vcf_file, in_paths, sequin_format, transl_table, clean_names, quiet, mmap_dir, 
+                packed, annot_cache_dir, encode_strings, False) for i, vcf_file in 
+                enumerate(parsnp_vcfs)]
+        results = pool.imap(_read_vcf_job, tasks)
+        if not quiet:
+            results = tqdm(results, total=len(tasks), desc="Reading VCF files")
+        for result in results:
+            for key, value in result.iteritems():
+                if key.startswith('vcf_mat_') and isinstance(value, tuple):
+                    filename, offset, dtype, shape, order = value
+                    value = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                            order=order)
+                vcf_data[key] = value
+    finally:
+        pool.terminate()
     
     return vcf_data
 
@@ -67,16 +151,62 @@ def write_npz(output, vcf_data):
     if output is None or output == '-':
         if sys.stdout.isatty():
             raise IOError("Can't print .npz data to a terminal. Please use -o or pipe to file.")
-        output = sys.stdout
-    np.savez(output, **vcf_data)
+        np.savez(sys.stdout, **vcf_data)
+        return
+    if not output.endswith('.npz'):
+        output += '.npz'
+    # Replace any previous file all at once, since e.g. parsnp_npz_server.py may have it mapped
+    save_npz_atomically(output, vcf_data)
+
+
+def write_shards(shard_dir, vcf_data):
+    """
+    Saves each array in `vcf_data` as an .npy file in a subdirectory of `shard_dir` for its cluster,
+    along with a manifest; see the description at the top of this file. The shards are written to
+    a temporary directory first, which then replaces any previous `shard_dir` all at once.
+    """
+    shard_dir = shard_dir.rstrip('/')
+    tmp_dir = tempfile.mkdtemp(dir=dirname(shard_dir) or '.', prefix=basename(shard_dir) + '.')
+    clusters = []
+    genomes = {}
+    for key in sorted(vcf_data.keys()):
+        name, index = re.match(r'^(.+)_(\d+)$', key).groups()
+        index = int(index)
+        while len(clusters) <= index:
+            clusters.append({"shard": str(len(clusters)), "arrays": {}})
+        shard = clusters[index]["shard"]
+        if not isdir(join(tmp_dir, shard)):
+            os.mkdir(join(tmp_dir, shard))
+        np.save(join(tmp_dir, shard, name + '.npy'), vcf_data[key])
+        clusters[index]["arrays"][name] = join(shard, name + '.npy')
+        if name == 'seq_list':
+            clusters[index]["genomes"] = vcf_data[key].tolist()
+            for row, genome in enumerate(vcf_data[key].tolist()):
+                genomes.setdefault(genome, {"cluster": index, "shard": shard, "row": row})
+    with open(join(tmp_dir, SHARD_MANIFEST), 'w') as f:
+        json.dump({"clusters": clusters, "genomes": genomes}, f)
+    
+    os.chmod(tmp_dir, 0755)
+    if isdir(shard_dir):
+        old_dir = tempfile.mkdtemp(dir=dirname(shard_dir) or '.', prefix=basename(shard_dir) + '.')
+        os.rename(shard_dir, join(old_dir, 'old'))
+        os.rename(tmp_dir, shard_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(tmp_dir, shard_dir)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('parsnp_vcfs', metavar='PARSNP_VCF_FILE', type=str, nargs='*', 
-            help='Path to the .vcf files (created with `harvesttools -i parsnp.ggr -V ...`).')
+            help='Path to the .vcf files (created with `harvesttools -i parsnp.ggr -V ...`). ' +
+            'Any of them may instead be a %s file saved by process_parsnp_vcf.py.' % 
+            SEGMENT_EXTENSION)
     parser.add_argument("-o", "--output", default=None, 
             help="Output numpy arrays to this file if set, otherwise will use STDOUT.")
+    parser.add_argument("-d", "--shard_dir", default=None, 
+            help="Also save the numpy arrays into one memory-mappable shard per VCF within this " +
+            "directory, along with a manifest.json. If used without -o, no .npz is written.")
     parser.add_argument("-f", "--fastas", default=None, 
             help="A file-of-filenames listing paths to the original fasta files for these " +
             "genomes. If given, they and corresponding annotation files (default: <filename>.bed) " +
@@ -89,6 +219,20 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--transl_table", type=int, default=DEFAULT_GENETIC_CODE, 
             help="Which NCBI Genetic Code table to use for AA translations; default=11 (bacterial)." +
             " For a full list see: https://www.ncbi.nlm.nih.gov/Taxonomy/Utils/wprintgc.cgi")
+    parser.add_argument("-e", "--encode_strings", default=False, action='store_true',
+            help="If used with --fastas, the gene and desc columns of the allele info are saved as " +
+            "indices into per-VCF tables of unique strings, which is much smaller.")
+    parser.add_argument("-a", "--annot_cache", default=None,
+            help="A directory for caching parsed reference sequences and annotations between runs." +
+            " Cached entries are keyed by the contents of the files, so they never go stale.")
+    parser.add_argument("-m", "--mmap_dir", default=None,
+            help="If given, alleles are streamed into temporary memory-mapped files within this " +
+            "directory instead of being held in memory.")
+    parser.add_argument("-p", "--packed_genotypes", default=False, action='store_true',
+            help="If used, allele calls are saved as bit-planes (one per non-reference allele) " +
+            "instead of an int16 matrix, which is much smaller.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="Number of VCF files to process in parallel; default=1")
     parser.add_argument("-q", "--quiet", default=False, action='store_true',
             help="Don't show progress bars while processing files.")
     args = parser.parse_args()
@@ -102,12 +246,21 @@ if __name__ == "__main__":
         with open(args.fastas, "r") as f:
             in_paths = map(lambda line: line.strip(), f.readlines())
     
+    tmp_dir = args.mmap_dir and tempfile.mkdtemp(dir=args.mmap_dir)
     vcf_data = read_vcfs(args.parsnp_vcfs, in_paths, args.sequin_annotations, args.transl_table,
-            args.clean_genome_names, args.quiet)
+            args.clean_genome_names, args.quiet, tmp_dir, args.packed_genotypes, args.annot_cache,
+            args.encode_strings, args.jobs)
     
     try:
-        write_npz(args.output, vcf_data)
+        if args.shard_dir is not None:
+            write_shards(args.shard_dir, vcf_data)
+        if args.output is not None or args.shard_dir is None:
+            write_npz(args.output, vcf_data)
     except IOError as e:
         sys.stderr.write("FATAL: " + e.message + "\n")
         parser.print_help(file=sys.stderr)
-        sys.exit(2)
\ No newline at end of file
+        sys.exit(2)
+    finally:
+        if tmp_dir is not None:
+            del vcf_data
+            shutil.rmtree(tmp_dir)
\ No newline at end of file
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+process_parsnp_vcf.py
+Reads the parsnp.complete.vcf made by `harvesttools -V` once, and from it creates:
+- the parsnp.vcf, which only keeps variants with a FILTER of PASS (along with the header lines)
+- a .tsv of SNV differences between genomes in that parsnp.vcf, as parsnp2table.py would
+- if --segment is given, an .npz segment of its arrays that parsnp_vcfs_to_npz.py can read instead
+  of parsing the parsnp.vcf again
+If [regex] is given, will also delete all [regex] matches from genome names in the .tsv
+
+USAGE: python process_parsnp_vcf.py parsnp.complete.vcf parsnp.vcf parsnp.tsv [regex]
+"""
+
+import os
+import shutil
+import tempfile
+import argparse
+import re
+
+from pylib.parsnp_vcf import load_parsnp_vcf
+from pylib.parsnp_npz import save_segment
+from pylib.packed_genotypes import pack_genotypes
+from pylib.snv_distances import snv_distances, write_distance_tsv
+
+
+def temp_path_for(path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+            prefix=os.path.basename(path) + '.')
+    os.close(fd)
+    return tmp_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('complete_vcf', metavar='PARSNP_COMPLETE_VCF',
+            help='Path to the parsnp.complete.vcf file')
+    parser.add_argument('output_vcf', metavar='OUTPUT_VCF',
+            help='Path for the filtered parsnp.vcf')
+    parser.add_argument('output_tsv', metavar='OUTPUT_TSV',
+            help='Path for the .tsv of SNV distances')
+    parser.add_argument('regex', metavar='REGEX', nargs='?', default=None,
+            help='A python regex, that if given, will be scrubbed out of genome names.')
+    parser.add_argument("-s", "--segment", default=None,
+            help="Also save the arrays read from the parsnp.vcf to this .segment.npz file.")
+    parser.add_argument("-m", "--mmap_dir", default=None,
+            help="If given, alleles are streamed into a temporary memory-mapped file within this " +
+            "directory instead of being held in memory.")
+    parser.add_argument("-b", "--backend", choices=('int16', 'packed'), default='int16',
+            help="How distances are calculated: by comparing rows of int16 alleles (the default), " +
+            "or by popcounts over genotypes packed into one bit-plane per non-reference allele.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+            help="Number of processes to calculate distances with; default=1")
+    args = parser.parse_args()
+
+    tmp_dir = args.mmap_dir and tempfile.mkdtemp(dir=args.mmap_dir)
+    mmap_path = tmp_dir and os.path.join(tmp_dir, 'vcf_mat.npy')
+    # Outputs are written under temporary names and renamed once complete, in the order they are
+    # listed above, so that Rake never sees a partial output as being up to date
+    tmp_vcf = temp_path_for(args.output_vcf)
+    tmp_tsv = temp_path_for(args.output_tsv)
+    try:
+        with open(tmp_vcf, 'w') as filtered_file:
+            seq_list, vcf_mat, vcf_allele_info = load_parsnp_vcf(args.complete_vcf, progress=True,
+                    mmap_path=mmap_path, filtered_file=filtered_file)
+        clean_seq_list = seq_list
+        if args.regex is not None:
+            clean_seq_list = map(lambda seq: re.sub(args.regex, '', seq), seq_list)
+
+        # Only the upper triangle of distances is computed, in tiles; see pylib.snv_distances
+        if args.backend == 'packed':
+            dist_mat = snv_distances(pack_genotypes(vcf_mat, progress=True), packed=True,
+                    progress=True, workers=args.workers)
+        else:
+            dist_mat = snv_distances(vcf_mat, progress=True, workers=args.workers)
+        write_distance_tsv(tmp_tsv, clean_seq_list, dist_mat)
+
+        os.chmod(tmp_vcf, 0644)
+        os.chmod(tmp_tsv, 0644)
+        os.rename(tmp_vcf, args.output_vcf)
+        os.rename(tmp_tsv, args.output_tsv)
+        if args.segment is not None:
+            save_segment(args.segment, seq_list, vcf_mat, vcf_allele_info)
+    finally:
+        for path in (tmp_vcf, tmp_tsv):
+            if os.path.exists(path): os.unlink(path)
+        if tmp_dir is not None:
+            vcf_mat = None
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,209 @@
+"""
+An on-disk cache of reference genomes and their parsed annotations, so that the same references
+don't have to be re-parsed with SeqIO and the annotation loaders for every cluster, every day.
+
+Within the cache directory, each reference .fasta gets a subdirectory named by the SHA1 hash of
+its contents, and within that, each set of annotations for it gets a subdirectory named by its
+format and the SHA1 hash of its contents. Therefore, changing either file invalidates the cache
+automatically. All arrays are saved as .npy files and loaded as memory maps.
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from Bio import SeqIO
+from collections import defaultdict
+
+from .get_annots import Annot, LazySeqRecord, get_bed_annots, get_sequin_annots
+from .utils import contig_to_vcf_chrom
+
+# Bump this whenever the layout of the cache changes, so that older caches are ignored
+CACHE_VERSION = "1"
+HASH_BLOCK_BYTES = 1024 * 1024
+
+_file_sha1_memo = {}
+
+
+class MappedContig(object):
+    """
+    Slices of one contig's sequence, as str, from a memory-mapped array of all of a reference's
+    contigs concatenated together. May be used in place of a contig str by LazySeqRecord.
+    """
+
+    def __init__(self, data, offset, size):
+        self.data = data
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.data[self.offset:self.offset + self.size][key].tostring()
+
+
+def file_sha1(path):
+    """
+    Returns the hex SHA1 hash of the contents of the file at `path`, along with CACHE_VERSION.
+    Hashes are remembered for as long as the file keeps the same size and mtime, so a reference is
+    only read once per process, although every cluster that uses it looks it up in the cache.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_sha1_memo:
+        sha1 = hashlib.sha1(CACHE_VERSION)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_BYTES), ''):
+                sha1.update(block)
+        _file_sha1_memo[memo_key] = sha1.hexdigest()
+    return _file_sha1_memo[memo_key]
+
+
+def _str_dtype(strs):
+    return 'S%d' % max([1] + map(len, strs))
+
+
+def _save_atomically(cache_path, arrays):
+    """
+    Saves each of `arrays` as an .npy file in a new directory that is then moved to `cache_path`,
+    so that concurrent readers never see a partially written cache.
+    """
+    parent = os.path.dirname(cache_path)
+    try:
+        os.makedirs(parent)
+    except OSError as e:
+        # Other --jobs workers may be creating the same directories at the same time
+        if e.errno != errno.EEXIST:
+            raise
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process beat us to it; it would have saved the same arrays
+        shutil.rmtree(tmp_path)
+
+
+def _load_arrays(cache_path, names):
+    arrays = []
+    for name in names:
+        path = os.path.join(cache_path, name + '.npy')
+        try:
+            arrays.append(np.load(path, mmap_mode='r'))
+        except ValueError:
+            # Empty arrays can't be memory-mapped
+            arrays.append(np.load(path))
+    return arrays
+
+
+def load_contigs(fasta_path, cache_dir):
+    """
+    Loads the contigs of the reference at `fasta_path` from the cache in `cache_dir`, adding them
+    to the cache first if necessary.
+
+    Returns a list of (contig ID, MappedContig) tuples in the same order as the .fasta file.
+    """
+    cache_path = os.path.join(cache_dir, file_sha1(fasta_path))
+    if not os.path.isdir(cache_path):
+        fasta_contigs = [(contig.id, str(contig.seq)) for contig in
+                SeqIO.parse(open(fasta_path), "fasta")]
+        contigs_index = np.zeros(len(fasta_contigs), dtype=[
+            ('id', _str_dtype([contig_id for contig_id, _ in fasta_contigs])),
+            ('offset', np.int64),
+            ('size', np.int64)
+        ])
+        contigs_index['id'] = [contig_id for contig_id, _ in fasta_contigs]
+        contigs_index['size'] = [len(seq) for _, seq in fasta_contigs]
+        contigs_index['offset'] = np.cumsum(contigs_index['size']) - contigs_index['size']
+        contigs = np.fromstring(''.join(seq for _, seq in fasta_contigs), dtype=np.uint8)
+        _save_atomically(cache_path, {'contigs': contigs, 'contigs_index': contigs_index})
+
+    contigs, contigs_index = _load_arrays(cache_path, ['contigs', 'contigs_index'])
+    return [(contig_id, MappedContig(contigs, offset, size)) for contig_id, offset, size in
+            contigs_index.tolist()]
+
+
+def load_chrom_sizes(fasta_path, cache_dir):
+    """
+    Like `load_contigs()`, but returns a list of (VCF CHROM name, size) tuples for the contigs.
+    """
+    return [(contig_to_vcf_chrom(contig_id), len(contig)) for contig_id, contig in
+            load_contigs(fasta_path, cache_dir)]
+
+
+def load_annots(fasta_path, annots_path, sequin_format, cache_dir, quiet=False):
+    """
+    Loads the annotations at `annots_path` for the reference at `fasta_path` from the cache in
+    `cache_dir`, parsing and adding them to the cache first if necessary.
+
+    Returns the same dictionary as `get_bed_annots()` or `get_sequin_annots()` would, but the
+    sequences of the Annots are sliced from the memory-mapped reference only when needed.
+    """
+    contigs = load_contigs(fasta_path, cache_dir)
+    annots_format = 'sequin' if sequin_format else 'bed'
+    cache_path = os.path.join(cache_dir, file_sha1(fasta_path),
+            annots_format + '-' + file_sha1(annots_path))
+    if not os.path.isdir(cache_path):
+        get_annots = get_sequin_annots if sequin_format else get_bed_annots
+        annots = get_annots(annots_path, dict(contigs), quiet, contig_strs=dict(contigs))
+        _save_atomically(cache_path, _annots_to_arrays(annots, contigs))
+
+    rows, blocks, segments = _load_arrays(cache_path, ['annots', 'blocks', 'segments'])
+    blocks = blocks.tolist()
+    segments = segments.tolist()
+    annots = defaultdict(list)
+    for (chrom, contig, start, end, rev_strand, gene_id, name, desc, has_desc, blocks_start,
+            blocks_end, segments_start, segments_end) in rows.tolist():
+        gene_seq_record = LazySeqRecord(contigs[contig][1],
+                map(tuple, segments[segments_start:segments_end]), rev_strand,
+                id=gene_id, name=name, description=desc if has_desc else None)
+        annot = Annot(start, end, rev_strand, gene_seq_record,
+                map(tuple, blocks[blocks_start:blocks_end]))
+        annots[chrom].append(annot)
+    return annots
+
+
+def _annots_to_arrays(annots, contigs):
+    """
+    Flattens the dictionary of `annots` into arrays that can be saved to the cache. Rows are saved
+    in the order of each contig's list of Annots, so `load_annots()` can rebuild those lists.
+    """
+    contig_indices = dict((id(contig), i) for i, (_, contig) in enumerate(contigs))
+    flat_annots = [(chrom, annot) for chrom, chrom_annots in annots.iteritems()
+            for annot in chrom_annots]
+    records = [annot.seq_record for _, annot in flat_annots]
+    rows = np.zeros(len(flat_annots), dtype=[
+        ('chrom', _str_dtype([chrom for chrom, _ in flat_annots])),
+        ('contig', np.int32),
+        ('start', np.int64),
+        ('end', np.int64),
+        ('rev_strand', np.bool_),
+        ('id', _str_dtype([record.id for record in records])),
+        ('name', _str_dtype([record.name for record in records])),
+        ('description', _str_dtype([record.description or "" for record in records])),
+        ('has_description', np.bool_),
+        ('blocks_start', np.int64),
+        ('blocks_end', np.int64),
+        ('segments_start', np.int64),
+        ('segments_end', np.int64)
+    ])
+    blocks = []
+    segments = []
+    for i, (chrom, annot) in enumerate(flat_annots):
+        record = annot.seq_record
+        rows[i] = (chrom, contig_indices[id(record.contig_str)], annot.start, annot.end,
+                annot.rev_strand, record.id, record.name, record.description or "",
+                record.description is not None,
+                len(blocks), len(blocks) + len(annot.coding_blocks),
+                len(segments), len(segments) + len(record.segments))
+        blocks.extend(annot.coding_blocks)
+        segments.extend(record.segments)
+    return {
+        'annots': rows,
+        'blocks': np.array(blocks, dtype=np.int64).reshape((-1, 2)),
+        'segments': np.array(segments, dtype=np.int64).reshape((-1, 2))
+    }
@@ -1,7 +1,7 @@
 import sys
 import re
+import numpy as np
 from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import generic_dna
 from collections import defaultdict
 
@@ -9,11 +9,67 @@ from .utils import contig_to_vcf_chrom
 
 COMMA_DELIM_INTEGERS = r'^(\d+( *, *)?)+$'
 
+# Memoized translations of single codons, keyed by (codon, NCBI genetic code); see `translate_codon()`
+_codon_translations = {}
+
+
+def translate_codon(codon, transl_table=11):
+    """
+    Translates a single `codon` to its amino acid using NCBI genetic code `transl_table`. Codons 
+    are translated by BioPython the first time they are seen, so ambiguous nucleotides are handled
+    exactly as they would be when translating a whole coding sequence.
+    """
+    key = (codon, transl_table)
+    if key not in _codon_translations:
+        _codon_translations[key] = str(Seq(codon, generic_dna).translate(table=transl_table))
+    return _codon_translations[key]
+
+
+class LazySeqRecord(object):
+    """
+    Stands in for a BioPython SeqRecord of a gene's sequence, but only keeps the str of the contig
+    it is on and (start, end) offsets of the segments that make it up. The gene's sequence is not
+    sliced out and joined together until `.seq` is first needed, e.g. for a translation.
+    Segments are listed in the order they appear on the contig; if `rev_strand` is True, the
+    sequence is the reverse complement.
+    """
+    
+    def __init__(self, contig_str, segments, rev_strand, id="", name="", description=""):
+        self.contig_str = contig_str
+        self.segments = segments
+        self.rev_strand = rev_strand
+        self.id = id
+        self.name = name
+        self.description = description
+        self._seq = None
+    
+    def __len__(self):
+        lengths = [slice(start, end).indices(len(self.contig_str)) for start, end in self.segments]
+        return sum(max(0, end - start) for start, end, _ in lengths)
+    
+    @property
+    def seq(self):
+        if self._seq is None:
+            seq_str = "".join(self.contig_str[start:end] for start, end in self.segments)
+            self._seq = Seq(seq_str, generic_dna)
+            if self.rev_strand:
+                self._seq = self._seq.reverse_complement()
+        return self._seq
+
+
+def _contig_str(ref_contigs, contig_strs, contig_name):
+    """Converts each contig in ref_contigs to a str only once, caching it in `contig_strs`."""
+    if contig_name not in contig_strs:
+        contig_strs[contig_name] = str(ref_contigs[contig_name].seq)
+    return contig_strs[contig_name]
+
+
 class Annot:
     """
     A class representing a generic annotation of a gene with a coding sequence.
     Note that this class does not store the name of the contig that the gene is on.
     All positions within this class are ZERO-indexed and ranges are RIGHT-OPEN, like BED files.
+    `seq_record` may be a BioPython SeqRecord or a LazySeqRecord.
     """
     
     def __init__(self, start, end, rev_strand, seq_record, coding_blocks=[]):
@@ -22,6 +78,13 @@ class Annot:
         self.rev_strand = rev_strand
         self.seq_record = seq_record
         self.coding_blocks = sorted(coding_blocks, key=lambda range: range[0])
+        self._seq_str = None
+
+    def seq_str(self):
+        """The coding sequence of this annotation as a str, which is cached after the first call."""
+        if self._seq_str is None:
+            self._seq_str = str(self.seq_record.seq)
+        return self._seq_str
 
     def nt_pos(self, pos):
         """
@@ -52,26 +115,81 @@ class Annot:
         aa_alts = []
         nt_pos = self.nt_pos(pos)
         aa_pos = self.aa_pos(pos)
+        seq = self.seq_str()
+        # pad partial codons for the rare off-length annotations to avoid a BiopythonWarning
+        seq_pad = "N" * (-len(seq) % 3)
+        # Substituting one nucleotide only changes the codon that contains it
+        codon_start = aa_pos * 3
+        ref_codon = (seq[codon_start:codon_start + 3] + seq_pad)[0:3]
+        codon_pos = nt_pos - codon_start
         for i, allele in enumerate(alts):
-            mut_seq = str(self.seq_record.seq)
             if self.rev_strand:
                 allele = str(Seq(allele, generic_dna).reverse_complement())
-            if i == 0 and mut_seq[nt_pos].upper() != allele.upper():
+            if i == 0 and seq[nt_pos].upper() != allele.upper():
                 # Sanity check: the reference (first) allele should be the nucleotide at nt_pos!
                 raise RuntimeError("Ref allele '%s' is incorrect for %s:c.%d" % (allele, 
                         self.seq_record.name, nt_pos + 1))
-            # pad partial codons for the rare off-length annotations to avoid a BiopythonWarning
-            mut_seq_pad = "N" * (-len(mut_seq) % 3)
-            mut_seq = mut_seq[0:nt_pos] + allele + mut_seq[nt_pos+1:None] + mut_seq_pad
-            mut_seq_aa = str(Seq(mut_seq, generic_dna).translate(table=transl_table))
-            aa_alts.append(mut_seq_aa[aa_pos])
+            if len(allele) == 1:
+                mut_codon = ref_codon[0:codon_pos] + allele + ref_codon[codon_pos+1:None]
+                aa_alts.append(translate_codon(mut_codon, transl_table))
+            else:
+                # Other alleles can shift the reading frame, so the whole sequence is translated
+                mut_seq = seq[0:nt_pos] + allele + seq[nt_pos+1:None] + seq_pad
+                mut_seq_aa = str(Seq(mut_seq, generic_dna).translate(table=transl_table))
+                aa_alts.append(mut_seq_aa[aa_pos])
         return aa_alts
 
 
-def get_bed_annots(bed_path, ref_contigs, quiet=False):
+class AnnotIndex:
+    """
+    An index of a list of Annots on one contig, for finding which of them overlap many positions 
+    at once. Annots may overlap each other; matches are always returned in their original order.
+    All positions are ZERO-indexed, like those of Annot.
+    """
+    
+    def __init__(self, annots):
+        self.annots = annots
+        starts = np.array([a.start for a in annots], dtype=np.int64)
+        ends = np.array([a.end for a in annots], dtype=np.int64)
+        # Empty Annots can't overlap anything, and would throw off the counts in `lookup()`
+        nonempty = np.flatnonzero(ends > starts)
+        self.order = nonempty[np.argsort(starts[nonempty], kind='mergesort')]
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+        self.sorted_ends = np.sort(ends[nonempty])
+        # No Annot can overlap a position if it starts more than this far before it
+        self.max_length = (self.ends - self.starts).max() if len(self.order) > 0 else 0
+    
+    def lookup(self, positions):
+        """
+        Given an array of `positions`, return a list with the list of Annots overlapping each one.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        matches = [[] for _ in range(len(positions))]
+        if len(self.order) == 0:
+            return matches
+        # Annots that start at or before a position, minus those that end at or before it, overlap it
+        num_started = np.searchsorted(self.starts, positions, side='right')
+        counts = num_started - np.searchsorted(self.sorted_ends, positions, side='right')
+        # Usually, the one overlapping Annot is the last to start before the position
+        last = np.maximum(num_started - 1, 0)
+        single = (counts == 1) & (self.ends[last] > positions)
+        for k in np.flatnonzero(single):
+            matches[k].append(self.annots[self.order[last[k]]])
+        # Otherwise, check every Annot that starts close enough before the position
+        first = np.searchsorted(self.starts, positions - self.max_length, side='right')
+        for k in np.flatnonzero((counts > 0) & ~single):
+            window = np.arange(first[k], num_started[k])
+            overlapping = np.sort(self.order[window[self.ends[window] > positions[k]]])
+            matches[k] = [self.annots[j] for j in overlapping]
+        return matches
+
+
+def get_bed_annots(bed_path, ref_contigs, quiet=False, contig_strs=None):
     """
     Load all genes in the BED file as SeqRecords, fetching their sequence data from the reference.
     ref_contigs is a dictionary of ref contig sequences created with BioPython's SeqIO.to_dict().
+    contig_strs may be a dictionary of the same contigs already converted to str (or MappedContig).
     
     For documentation on the BED format, see: https://genome.ucsc.edu/FAQ/FAQformat.html#format1
     
@@ -79,6 +197,7 @@ def get_bed_annots(bed_path, ref_contigs, quiet=False):
     coding_blocks) tuples for each contig in ref_contigs.
     """
     annots = defaultdict(list)
+    contig_strs = {} if contig_strs is None else contig_strs
     with open(bed_path) as f:
         for line in f:
             line = line.strip().split("\t")
@@ -86,11 +205,9 @@ def get_bed_annots(bed_path, ref_contigs, quiet=False):
             chrom, start, end, name, strand = line[0], int(line[1]), int(line[2]), line[3], line[5]
             gene_id = line[12] if len(line) >= 13 else ""
             desc = line[13] if len(line) >= 14 else ""
-            ref_contig = ref_contigs[chrom]
-            gene_seq = Seq(str(ref_contig.seq)[start:end], generic_dna)
-            if strand == '-':
-                gene_seq = gene_seq.reverse_complement()
-            gene_seq_record = SeqRecord(gene_seq, id=gene_id, name=name, description=desc)
+            ref_contig_str = _contig_str(ref_contigs, contig_strs, chrom)
+            gene_seq_record = LazySeqRecord(ref_contig_str, [(start, end)], strand == '-', 
+                    id=gene_id, name=name, description=desc)
             
             coding_blocks = []
             if (len(line) >= 12 and line[9].isdigit() and re.match(COMMA_DELIM_INTEGERS, line[10])
@@ -119,10 +236,11 @@ def get_bed_annots(bed_path, ref_contigs, quiet=False):
     return annots
 
 
-def get_sequin_annots(sequin_path, ref_contigs, quiet=False):
+def get_sequin_annots(sequin_path, ref_contigs, quiet=False, contig_strs=None):
     """
     Load all genes in the Sequin table as SeqRecords, fetching their sequence data from the reference.
     ref_contigs is a dictionary of ref contig sequences created with BioPython's SeqIO.to_dict().
+    contig_strs may be a dictionary of the same contigs already converted to str (or MappedContig).
     
     For documentation on the Sequin table format, see: https://www.ncbi.nlm.nih.gov/Sequin/table.html
     
@@ -130,6 +248,7 @@ def get_sequin_annots(sequin_path, ref_contigs, quiet=False):
     coding_blocks) tuples for each contig in ref_contigs.
     """
     annots = defaultdict(list)
+    contig_strs = {} if contig_strs is None else contig_strs
     
     # We need a dummy class to hold the current state while parsing
     # (otherwise the below private functions can't modify it; there's no "nonlocal" in python 2.x)
@@ -141,26 +260,26 @@ def get_sequin_annots(sequin_path, ref_contigs, quiet=False):
         chrom_start = None
         chrom_end = None
         strand = None
-        feature_seq_str = ""
         coding_blocks = []
     
     def _save_sequin_feature():
         # The only features we care about are the CDS features. Others get discarded during parsing.
         if _.in_feature == "CDS":
-            if len(_.feature_seq_str) == 0:
+            ref_contig_str = _contig_str(ref_contigs, contig_strs, _.in_contig)
+            # The CDS's segments were added in order of the coding sequence; on the - strand, that
+            # is the reverse of their order on the contig
+            segments = _.coding_blocks[::-1] if _.strand == '-' else _.coding_blocks
+            gene_seq_record = LazySeqRecord(ref_contig_str, segments, _.strand == '-', 
+                    id=_.gene_name, name=_.gene_name, description=_.desc)
+            if len(gene_seq_record) == 0:
                 if not quiet: sys.stderr.write("WARN: 0-length CDS in contig %s" % _.in_contig)
             elif _.gene_name is None or _.strand is None or _.chrom_start is None or _.chrom_end is None:
                 if not quiet: sys.stderr.write("WARN: invalid CDS feature in contig %s" % _.in_contig)
             else:
-                gene_seq = Seq(_.feature_seq_str, generic_dna)
-                if _.strand == '-':
-                    gene_seq = gene_seq.reverse_complement()
-                gene_seq_record = SeqRecord(gene_seq, id=_.gene_name, name=_.gene_name, description=_.desc)
                 annot = Annot(_.chrom_start, _.chrom_end, _.strand == '-', gene_seq_record, 
                         _.coding_blocks)
                 annots[contig_to_vcf_chrom(_.in_contig)].append(annot)
         _.in_feature = _.gene_name = _.desc = _.chrom_start = _.chrom_end = _.strand = None
-        _.feature_seq_str = ""
         _.coding_blocks = []
         
     def _update_sequin_feature(fields):
@@ -172,7 +291,7 @@ def get_sequin_annots(sequin_path, ref_contigs, quiet=False):
                 _.in_feature = "CDS-partial"
                 return
 
-            # Append the specified sequence to the `_.feature_seq_str`.
+            # Add the specified sequence range to the `_.coding_blocks`.
             # Note: Sequin table coordinates, like GenBank, are 1-indexed, right-closed.
             start = int(fields[0])
             end = int(fields[1])
@@ -185,10 +304,7 @@ def get_sequin_annots(sequin_path, ref_contigs, quiet=False):
             if _.strand == '-':
                 start, end = end, start
             start -= 1
-            ref_contig = ref_contigs[_.in_contig]
-            seg = str(ref_contig.seq)[start:end]
             _.coding_blocks.append((start, end))
-            _.feature_seq_str = seg + _.feature_seq_str if _.strand == '-' else _.feature_seq_str + seg
             _.chrom_start = min(start, _.chrom_start if _.chrom_start is not None else float('inf'))
             _.chrom_end = max(end, _.chrom_end if _.chrom_end is not None else float('-inf'))
             
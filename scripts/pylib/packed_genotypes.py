@@ -0,0 +1,66 @@
+import numpy as np
+from tqdm import tqdm
+
+# Variants are packed in chunks of this many columns, so memory-mapped matrices of alleles are
+# never read into memory all at once. It must be a multiple of 64, so chunks align to words.
+PACK_CHUNK_VARIANTS = 1 << 16
+# Constants for the SWAR popcount in `popcount64()`; they must stay np.uint64, because NumPy
+# upcasts uint64 arrays combined with python ints to float64
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+_SHIFTS = [np.uint64(n) for n in (1, 2, 4, 56)]
+
+
+def packed_width(n_variants):
+    """
+    Returns the number of bytes each sequence's bit-plane takes for `n_variants` variants,
+    rounded up to a whole number of 64-bit words.
+    """
+    return -(-n_variants // 64) * 8
+
+
+def pack_genotypes(vcf_mat, progress=False):
+    """
+    Packs a (sequences, variants) matrix of alleles, as returned by `load_parsnp_vcf()`, into
+    bit-planes: one per non-reference allele, where a bit is set if that sequence has that allele
+    at that variant. The REF allele (0) is implied by the absence of any set bit.
+
+    Returns a uint8 array with shape (max allele, sequences, `packed_width(variants)`). The last
+    axis is padded with zeros so that it can be viewed as 64-bit words.
+    """
+    n_seqs, n_variants = vcf_mat.shape
+    n_planes = int(vcf_mat.max()) if vcf_mat.size > 0 else 0
+    vcf_bits = np.zeros((n_planes, n_seqs, packed_width(n_variants)), dtype=np.uint8)
+    chunks = range(0, n_variants, PACK_CHUNK_VARIANTS)
+    if progress:
+        chunks = tqdm(chunks, desc="Packing genotypes")
+    for start in chunks:
+        block = np.asarray(vcf_mat[:, start:start + PACK_CHUNK_VARIANTS])
+        byte_start = start // 8
+        byte_end = byte_start + -(-block.shape[1] // 8)
+        for allele in range(1, n_planes + 1):
+            vcf_bits[allele - 1, :, byte_start:byte_end] = np.packbits(block == allele, axis=1)
+    return vcf_bits
+
+
+def unpack_genotypes(vcf_bits, n_variants):
+    """
+    Reverses `pack_genotypes()`, returning the int16 (sequences, variants) matrix of alleles.
+    `n_variants` is needed to drop the padding; it is the size of the matching allele info array.
+    """
+    vcf_mat = np.zeros(vcf_bits.shape[1:2] + (n_variants,), dtype=np.int16)
+    for plane in range(vcf_bits.shape[0]):
+        has_allele = np.unpackbits(vcf_bits[plane], axis=1)[:, :n_variants].astype(bool)
+        vcf_mat[has_allele] = plane + 1
+    return vcf_mat
+
+
+def popcount64(words):
+    """Counts the set bits in each element of a uint64 array, without any lookup tables."""
+    words = words - ((words >> _SHIFTS[0]) & _M1)
+    words = (words & _M2) + ((words >> _SHIFTS[1]) & _M2)
+    words = (words + (words >> _SHIFTS[2])) & _M4
+    return (words * _H01) >> _SHIFTS[3]
+
@@ -0,0 +1,279 @@
+"""
+Lazy, indexed access to the .parsnp.vcfs.npz files (or shard directories) written by
+parsnp_vcfs_to_npz.py, for answering queries like "which sites are polymorphic among these genomes,
+within this contig or range of positions?" without reading whole arrays into memory.
+"""
+
+import os
+import re
+import json
+import struct
+import zipfile
+import tempfile
+import numpy as np
+from collections import namedtuple
+
+from .packed_genotypes import unpack_genotypes
+from .parsnp_vcf import ENCODED_ALLELE_INFO_FIELDS, decode_allele_info
+
+SHARD_MANIFEST = 'manifest.json'
+SEGMENT_EXTENSION = '.segment.npz'
+ZIP_LOCAL_HEADER_BYTES = 30
+
+GenotypeSubset = namedtuple('GenotypeSubset', ['cluster', 'seq_list', 'sites', 'vcf_mat',
+        'allele_info'])
+
+
+def _npz_member_memmap(path, zip_info):
+    """
+    np.savez() stores arrays in the .npz without compression, so they can be memory-mapped straight
+    from the .npz file by skipping over the zip and .npy headers. Returns None if that's impossible.
+    """
+    if zip_info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        f.seek(zip_info.header_offset)
+        local_header = f.read(ZIP_LOCAL_HEADER_BYTES)
+        if local_header[0:4] != zipfile.stringFileHeader:
+            return None
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(zip_info.header_offset + ZIP_LOCAL_HEADER_BYTES + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    if np.prod(shape) == 0:
+        # Empty arrays can't be memory-mapped
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+            order='F' if fortran_order else 'C')
+
+
+def save_npz_atomically(path, arrays):
+    """
+    Saves `arrays` to the .npz file at `path`, writing it under a temporary name first and then
+    renaming it, so that processes with a previous file at `path` memory-mapped keep reading it
+    intact instead of seeing it truncated, and no partially written file is ever left at `path`.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+            prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0666 & ~umask)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_segment(path, seq_list, vcf_mat, vcf_allele_info):
+    """
+    Saves the arrays read from one parsnp.vcf by `load_parsnp_vcf()` to an .npz segment at `path`,
+    which parsnp_vcfs_to_npz.py can read in place of the parsnp.vcf without parsing it again.
+    """
+    save_npz_atomically(path, {'seq_list': np.array(seq_list), 'vcf_mat': vcf_mat,
+            'vcf_allele_info': vcf_allele_info})
+
+
+def load_segment(path):
+    """
+    Loads an .npz segment saved by `save_segment()`, returning the same tuple as `load_parsnp_vcf()`.
+    The matrix of alleles is memory-mapped from the segment, if possible.
+    """
+    with zipfile.ZipFile(path) as zf:
+        zip_infos = dict((info.filename[:-4], info) for info in zf.infolist())
+    vcf_mat = _npz_member_memmap(path, zip_infos['vcf_mat'])
+    npz = np.load(path)
+    if vcf_mat is None:
+        vcf_mat = npz['vcf_mat']
+    return npz['seq_list'].tolist(), vcf_mat, npz['vcf_allele_info']
+
+
+class ParsnpNpz(object):
+    """
+    Opens a .parsnp.vcfs.npz file, or a directory of shards written with `--shard_dir`, lazily.
+    Arrays for each cluster are memory-mapped the first time they are needed. All formats written
+    by parsnp_vcfs_to_npz.py are supported, including packed genotypes and encoded strings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._arrays = {}
+        self._site_indexes = {}
+        if os.path.isdir(path):
+            with open(os.path.join(path, SHARD_MANIFEST)) as f:
+                manifest = json.load(f)
+            self._array_paths = {}
+            for index, cluster in enumerate(manifest["clusters"]):
+                for name, array_path in cluster["arrays"].iteritems():
+                    self._array_paths[(str(name), index)] = os.path.join(path, array_path)
+            self.num_clusters = len(manifest["clusters"])
+        else:
+            with zipfile.ZipFile(path) as zf:
+                self._zip_infos = dict((info.filename[:-4], info) for info in zf.infolist())
+            self._array_paths = None
+            indices = [int(re.match(r'^.+_(\d+)$', key).group(1)) for key in self._zip_infos]
+            self.num_clusters = max(indices) + 1 if len(indices) > 0 else 0
+
+        # Index every genome by the cluster it is in and its row in that cluster's genotypes
+        self.genomes = {}
+        for cluster in range(self.num_clusters):
+            for row, genome in enumerate(self.array(cluster, 'seq_list').tolist()):
+                self.genomes.setdefault(genome, (cluster, row))
+
+    def has_array(self, cluster, name):
+        if self._array_paths is not None:
+            return (name, cluster) in self._array_paths
+        return '%s_%d' % (name, cluster) in self._zip_infos
+
+    def array(self, cluster, name):
+        """
+        Returns the array `name` for the `cluster`, e.g. `array(3, 'vcf_mat')` for 'vcf_mat_3'.
+        """
+        key = '%s_%d' % (name, cluster)
+        if key not in self._arrays:
+            if self._array_paths is not None:
+                array_path = self._array_paths[(name, cluster)]
+                try:
+                    self._arrays[key] = np.load(array_path, mmap_mode='r')
+                except ValueError:
+                    # Empty arrays can't be memory-mapped
+                    self._arrays[key] = np.load(array_path)
+            else:
+                array = _npz_member_memmap(self.path, self._zip_infos[key])
+                if array is None:
+                    array = np.load(self.path)[key]
+                self._arrays[key] = array
+        return self._arrays[key]
+
+    def cluster_nbytes(self, cluster):
+        """Returns the total size of the arrays for the `cluster` that are currently loaded."""
+        suffix = '_%d' % cluster
+        nbytes = sum(array.nbytes for key, array in self._arrays.iteritems()
+                if key.endswith(suffix))
+        if cluster in self._site_indexes:
+            order, _, positions = self._site_indexes[cluster]
+            nbytes += order.nbytes + positions.nbytes
+        return nbytes
+
+    def release(self, cluster):
+        """
+        Drops the loaded arrays and site index for the `cluster`, unmapping them once no other
+        references remain. They are loaded again if needed.
+        """
+        suffix = '_%d' % cluster
+        for key in [key for key in self._arrays if key.endswith(suffix)]:
+            del self._arrays[key]
+        self._site_indexes.pop(cluster, None)
+
+    def num_variants(self, cluster):
+        return len(self.array(cluster, 'vcf_allele_info'))
+
+    def genotypes(self, cluster, rows=None, sites=None):
+        """
+        Returns the int16 matrix of alleles for the `cluster`, optionally subset to the given
+        `rows` (genomes) and `sites` (variants), unpacking them first if they were packed.
+        """
+        rows = slice(None) if rows is None else rows
+        sites = slice(None) if sites is None else sites
+        if isinstance(sites, np.ndarray) and len(sites) > 0 and np.all(np.diff(sites) == 1):
+            # A contiguous run of sites can be sliced as a view instead of being copied
+            sites = slice(sites[0], sites[-1] + 1)
+        if self.has_array(cluster, 'vcf_bits'):
+            vcf_bits = self.array(cluster, 'vcf_bits')
+            vcf_mat = unpack_genotypes(vcf_bits[:, rows, :], self.num_variants(cluster))
+            return vcf_mat[:, sites]
+        # Alleles are stored variant-major, so selecting the sites first reads the least data
+        return np.asarray(self.array(cluster, 'vcf_mat')[:, sites][rows])
+
+    def allele_info(self, cluster, sites=None):
+        """
+        Returns the allele info for the `cluster`, optionally subset to the given `sites`.
+        Encoded strings are decoded, so this always has the same dtype as was saved before encoding.
+        """
+        allele_info = self.array(cluster, 'vcf_allele_info')
+        allele_info = np.asarray(allele_info if sites is None else allele_info[sites])
+        if self.has_array(cluster, 'gene_table'):
+            tables = dict((name, self.array(cluster, name + '_table')) for name in
+                    ENCODED_ALLELE_INFO_FIELDS)
+            allele_info = decode_allele_info(allele_info, tables)
+        return allele_info
+
+    def sites(self, cluster, chrom=None, start=None, end=None):
+        """
+        Returns the indices of the variants in the `cluster` that are on contig `chrom` and within
+        positions `start` to `end`, as sorted by contig and position. Like the VCF's POS, positions
+        are 1-indexed and the range includes both ends; any of these may be None to not filter.
+        """
+        if cluster not in self._site_indexes:
+            allele_info = self.array(cluster, 'vcf_allele_info')
+            chroms = np.asarray(allele_info['chrom'])
+            positions = np.asarray(allele_info['pos'])
+            order = np.lexsort((positions, chroms))
+            # Sites on each contig form one block of `order`, within which positions are sorted
+            chrom_names, chrom_starts = np.unique(chroms[order], return_index=True)
+            chrom_bounds = zip(chrom_starts, list(chrom_starts[1:]) + [len(order)])
+            self._site_indexes[cluster] = (order, dict(zip(chrom_names, chrom_bounds)), 
+                    positions[order])
+        order, chrom_bounds, positions = self._site_indexes[cluster]
+        if chrom is not None:
+            blocks = [chrom_bounds[chrom]] if chrom in chrom_bounds else []
+        else:
+            blocks = sorted(chrom_bounds.values())
+        sites = []
+        for lo, hi in blocks:
+            block_positions = positions[lo:hi]
+            if end is not None:
+                hi = lo + np.searchsorted(block_positions, end, side='right')
+            if start is not None:
+                lo += np.searchsorted(block_positions, start, side='left')
+            sites.append(order[lo:hi])
+        return np.concatenate(sites) if len(sites) > 0 else np.zeros(0, dtype=order.dtype)
+
+    def cluster_rows(self, genomes):
+        """
+        Returns the cluster that all of the `genomes` are in, and their rows within it. Raises a
+        KeyError for unknown genomes and a ValueError if they are in more than one cluster.
+        """
+        locations = [self.genomes[genome] for genome in genomes]
+        clusters = set(cluster for cluster, _ in locations)
+        if len(clusters) != 1:
+            raise ValueError("Genomes must all be in one cluster; found %d clusters" % len(clusters))
+        return clusters.pop(), np.array([row for _, row in locations], dtype=np.intp)
+
+    def subset(self, genomes, chrom=None, start=None, end=None, polymorphic_only=True):
+        """
+        Subsets the cluster containing all of the `genomes` to the variants on contig `chrom` and
+        within positions `start` to `end` (see `sites()`). Unless `polymorphic_only` is False,
+        sites where all of the `genomes` have the same allele are dropped.
+
+        Returns a GenotypeSubset of the cluster, `genomes`, the indices of the sites in the
+        cluster's full arrays, their (genomes, sites) int16 matrix of alleles, and allele info.
+        """
+        cluster, rows = self.cluster_rows(genomes)
+        return self.cluster_subset(cluster, rows, chrom, start, end, polymorphic_only)
+
+    def cluster_subset(self, cluster, rows=None, chrom=None, start=None, end=None,
+            polymorphic_only=True):
+        """
+        Like `subset()`, but for the given `rows` of the `cluster`, or all of them if `rows` is None.
+        Genomes are not looked up by name, so this works even if their names repeat across clusters.
+        """
+        seq_list = self.array(cluster, 'seq_list').tolist()
+        if rows is None:
+            rows = np.arange(len(seq_list), dtype=np.intp)
+        sites = self.sites(cluster, chrom, start, end)
+        vcf_mat = self.genotypes(cluster, rows, sites)
+        if polymorphic_only and len(rows) > 0:
+            polymorphic = (vcf_mat != vcf_mat[0]).any(axis=0)
+            sites = sites[polymorphic]
+            vcf_mat = vcf_mat[:, polymorphic]
+        return GenotypeSubset(cluster, [seq_list[row] for row in rows], sites, vcf_mat,
+                self.allele_info(cluster, sites))
@@ -1,12 +1,14 @@
 import re
-import subprocess
+import os
+import struct
 import numpy as np
 from tqdm import tqdm
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
 
-from .get_annots import get_bed_annots, get_sequin_annots
+from .get_annots import AnnotIndex, get_bed_annots, get_sequin_annots
+from .annot_cache import load_annots, load_chrom_sizes
 from .utils import contig_to_vcf_chrom
 
 # For parsnp.vcf files produced by pathogendb-comparison, a CHROM field of 20 bytes would be 
@@ -26,74 +28,178 @@ ALLELE_INFO_EXTENDED_DTYPE = np.dtype(ALLELE_INFO_FIELDS + [
     ('aa_alt', 'S20'),
     ('desc', 'S40')
 ])
+# The gene and desc columns repeat the same few thousand strings, so they may be dictionary-encoded,
+# replacing them with indices into per-cluster tables of strings; see `encode_allele_info()`
+ENCODED_ALLELE_INFO_FIELDS = ['gene', 'desc']
+ALLELE_INFO_ENCODED_DTYPE = np.dtype([(name, np.uint32 if name in ENCODED_ALLELE_INFO_FIELDS else 
+        ALLELE_INFO_EXTENDED_DTYPE.fields[name][0]) for name in ALLELE_INFO_EXTENDED_DTYPE.names])
 CHROM_SIZES_DTYPE = np.dtype([('chrom', 'S40'), ('size', np.uint64)])
 DEFAULT_GENETIC_CODE = 11
+# The body of a VCF is parsed in chunks of lines totalling roughly this many bytes
+VCF_CHUNK_BYTES = 16 * 1024 * 1024
+# Initial number of variants that buffers are sized for; they double in size as needed
+INITIAL_VARIANT_CAPACITY = 4096
+# Fixed size of .npy headers written by `write_npy_header()`, so they can be rewritten in place
+NPY_HEADER_BYTES = 128
 
 
-def load_parsnp_vcf(filename, progress=True):
+def _parse_vcf_lines(lines, num_seqs):
+    """
+    Parses a list of VCF body lines into an array of allele info and a (len(lines), num_seqs) 
+    matrix of alleles, converting all of the allele columns with NumPy in one step.
+    """
+    lines = [line for line in lines if line.strip() != '']
+    allele_info = np.zeros(len(lines), dtype=ALLELE_INFO_DTYPE)
+    # The first 9 columns are standard VCF columns with allele info; the rest are alleles
+    cells = [line.split(None, 9) for line in lines]
+    allele_info['chrom'] = [row[0] for row in cells]
+    allele_info['pos'] = np.array([row[1] for row in cells]).astype(np.uint64)
+    # We prepend the REF to the ALT, because some VCFs use allele 0, which is the REF
+    allele_info['alt'] = [row[3] + ',' + row[4] for row in cells]
+    alleles = np.fromstring(' '.join(row[9] for row in cells), dtype=np.int16, sep=' ')
+    if alleles.size != len(lines) * num_seqs:
+        raise ValueError("Expected %d integer alleles on every VCF line" % num_seqs)
+    return allele_info, alleles.reshape(len(lines), num_seqs)
+
+
+def passes_filter(line):
+    """
+    Whether a VCF line would be kept by `awk -F '\t' '$7=="PASS" || $1~/^#/'`, which is how
+    parsnp.vcf files have always been filtered from harvesttools' parsnp.complete.vcf: header lines
+    are kept, along with variants whose FILTER column is PASS.
+    """
+    if line.startswith('#'): return True
+    fields = line.rstrip('\n').split('\t', 7)
+    return len(fields) > 6 and fields[6] == 'PASS'
+
+
+def write_npy_header(f, dtype, shape):
+    """
+    Writes a version 1.0 .npy header for a C-ordered array of `dtype` and `shape` at the start of 
+    the file `f`. It is padded to NPY_HEADER_BYTES, so that data can be appended after it in 
+    blocks, and the header rewritten in place once the final shape is known.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    magic = np.lib.format.magic(1, 0)
+    header = header.ljust(NPY_HEADER_BYTES - len(magic) - 3) + "\n"
+    f.seek(0)
+    f.write(magic + struct.pack('<H', len(header)) + header)
+
+
+def load_parsnp_vcf(filename, progress=True, mmap_path=None, filtered_file=None):
     """
     Loads a parsnp.vcf file produced by parsnp into a NumPy matrix of alleles, along with another
     NumPy array of allele info which contains the CHROM, POS, and ALT fields.
     
+    If `mmap_path` is given, alleles are streamed into an .npy file at that path as they are read, 
+    instead of being held in memory, and the matrix of alleles is memory-mapped from that file.
+    
+    If `filtered_file` is given, `filename` is instead an unfiltered parsnp.complete.vcf; only the 
+    lines kept by `passes_filter()` are loaded, and they are also written to `filtered_file`, 
+    so that the parsnp.vcf is created in the same pass.
+    
     Returns the list of sequences in the VCF, the matrix of alleles, and the array of allele info
-    as a tuple.
+    as a tuple. The matrix of alleles is a (sequences, variants) shaped, Fortran-ordered view 
+    of the variant-major buffer it was read into, so the alleles for a variant are contiguous.
     """
-    # Read in the VCF file
+    seq_list = None
     with open(filename) as vcf:
-        start_reading = False
-        total_lines = int(subprocess.check_output(['wc', '-l', filename]).split()[0])
-        i = 0
-        vcf_iter = tqdm(vcf, total=total_lines, desc="Reading VCF file") if progress else vcf
-        for line in vcf_iter:
-            # Skip all lines until we get to the #CHROM line
-            # The first 9 columns are standard VCF columns with allele info
+        # Skip all lines until we get to the #CHROM line. (Iterating over `vcf` would read ahead,
+        # which doesn't mix with the readlines() below.)
+        for line in iter(vcf.readline, ''):
+            if filtered_file is not None and passes_filter(line):
+                filtered_file.write(line)
             if line.startswith('#CHROM'):
                 # Get the remaining column headers, which are the names of the input sequences
                 seq_list = line.split()[9:]
-                # Initialize a matrix that can hold all variants for all sequences
-                # Conservatively, allocate enough rows for the total number of lines in the file
-                # Because of lines skipped above for the VCF header, this is a slight overestimate
-                vcf_mat = np.zeros((len(seq_list), total_lines), dtype=np.int16)
-                vcf_allele_info = np.zeros(total_lines, dtype=ALLELE_INFO_DTYPE)
-                # Start reading rows
-                start_reading = True
-            elif start_reading:
-                # Each cell is an allele for a particular sequence
-                cells = line.split()
-                vcf_mat[:, i] = map(int, line.split()[9:])
-                # VCF columns are 
-                # We prepend the REF to the ALT, because some VCFs use allele 0, which is the REF
-                vcf_allele_info[i] = (cells[0], int(cells[1]), cells[3] + ',' + cells[4])
-                i += 1
-
-    # Trim the rows of numpy data to the actual number of lines read from the file
-    vcf_mat = np.delete(vcf_mat, np.s_[i:], axis=1)
-    vcf_allele_info = np.delete(vcf_allele_info, np.s_[i:])
+                break
+        if seq_list is None:
+            raise ValueError("No #CHROM header line found in %s" % filename)
+        
+        # Buffers grow geometrically as variants are read, instead of being sized up front
+        if mmap_path is not None:
+            vcf_mat_file = open(mmap_path, 'wb')
+            write_npy_header(vcf_mat_file, np.int16, (0, len(seq_list)))
+        else:
+            vcf_mat = np.zeros((INITIAL_VARIANT_CAPACITY, len(seq_list)), dtype=np.int16)
+        vcf_allele_info = np.zeros(INITIAL_VARIANT_CAPACITY, dtype=ALLELE_INFO_DTYPE)
+        i = 0
+        if progress:
+            pbar = tqdm(total=os.path.getsize(filename), initial=vcf.tell(), unit='B', 
+                    unit_scale=True, desc="Reading VCF file")
+        while True:
+            lines = vcf.readlines(VCF_CHUNK_BYTES)
+            if len(lines) == 0: break
+            read_bytes = sum(len(line) for line in lines)
+            if filtered_file is not None:
+                lines = filter(passes_filter, lines)
+                filtered_file.writelines(lines)
+                lines = [line for line in lines if not line.startswith('#')]
+            allele_info, alleles = _parse_vcf_lines(lines, len(seq_list))
+            if i + len(alleles) > len(vcf_allele_info):
+                capacity = max(len(vcf_allele_info) * 2, i + len(alleles))
+                vcf_allele_info.resize(capacity, refcheck=False)
+                if mmap_path is None: vcf_mat.resize((capacity, len(seq_list)), refcheck=False)
+            if mmap_path is not None: 
+                alleles.tofile(vcf_mat_file)
+            else:
+                vcf_mat[i:i + len(alleles)] = alleles
+            vcf_allele_info[i:i + len(alleles)] = allele_info
+            i += len(alleles)
+            if progress: pbar.update(read_bytes)
+        if progress: pbar.close()
+
+    # Trim the buffers to the actual number of variants read from the file, in place
+    # For an .npy file, only its header needs to be updated with the final shape
+    if mmap_path is not None:
+        write_npy_header(vcf_mat_file, np.int16, (i, len(seq_list)))
+        vcf_mat_file.close()
+        vcf_mat = np.load(mmap_path, mmap_mode='r')
+    else:
+        vcf_mat.resize((i, len(seq_list)), refcheck=False)
+    vcf_allele_info.resize(i, refcheck=False)
 
     # Cleanup the names of sequences, which come with unnecessary suffixes from preprocessing steps
     seq_list = map(lambda x: re.sub(r'(\.\w+)+$', '', x), seq_list)
     
     # Return everything promised as a tuple.
-    return seq_list, vcf_mat, vcf_allele_info
+    return seq_list, vcf_mat.T, vcf_allele_info
 
 
 def enhance_allele_info(vcf_allele_info, fasta_path, annots_path, sequin_format=False, 
-        transl_table=DEFAULT_GENETIC_CODE, progress=True):
+        transl_table=DEFAULT_GENETIC_CODE, progress=True, cache_dir=None):
     """
     Takes the `vcf_allele_info` NumPy array produced by the above `load_parsnp_vcf()` function and
     enhances each row with `gene`, `nt_pos`, `aa_pos`, `aa_alt`, and `desc` information using the 
     reference genome sequence data at `fasta_path` and annotations at `annots_path`.
     
+    If `cache_dir` is given, the reference and annotations are loaded from (and if necessary, 
+    saved to) the cache of parsed annotations in that directory; see `pylib.annot_cache`.
+    
     TODO: could use more a systematic variant nomenclature, e.g. http://varnomen.hgvs.org/
     """
     vcf_alleles_extended = np.zeros(len(vcf_allele_info), dtype=ALLELE_INFO_EXTENDED_DTYPE)
     
-    # Load the reference genome's contigs as SeqRecords into their own dictionary.
-    ref_contigs = SeqIO.to_dict(SeqIO.parse(open(fasta_path), "fasta"))
+    if cache_dir is not None:
+        annots = load_annots(fasta_path, annots_path, sequin_format, cache_dir, quiet=not progress)
+    else:
+        # Load the reference genome's contigs as SeqRecords into their own dictionary.
+        ref_contigs = SeqIO.to_dict(SeqIO.parse(open(fasta_path), "fasta"))
+        
+        # Load annotations from the `annots_path`.
+        get_annots = get_sequin_annots if sequin_format else get_bed_annots
+        annots = get_annots(annots_path, ref_contigs, quiet=not progress)
     
-    # Load annotations from the `annots_path`.
-    get_annots = get_sequin_annots if sequin_format else get_bed_annots
-    annots = get_annots(annots_path, ref_contigs, quiet=not progress)
+    # Find the genes overlapping every VCF allele up front, with one query per contig
+    # VCF coordinates for the POS column are 1-indexed. This resets them to 0-indexed.
+    positions = vcf_allele_info['pos'].astype(np.int64) - 1
+    allele_genes = [[]] * len(vcf_allele_info)
+    for chrom in np.unique(vcf_allele_info['chrom']):
+        on_chrom = np.flatnonzero(vcf_allele_info['chrom'] == chrom)
+        chrom_genes = AnnotIndex(annots.get(chrom, [])).lookup(positions[on_chrom])
+        for i, genes in zip(on_chrom, chrom_genes):
+            allele_genes[i] = genes
     
     # Iterate through the VCF alleles, finding which genes they correspond to, and translating versions
     # of the gene for each allele to figure out the corresponding AA variants
@@ -102,8 +208,7 @@ def enhance_allele_info(vcf_allele_info, fasta_path, annots_path, sequin_format=
         # VCF coordinates for the POS column are 1-indexed. This resets them to 0-indexed.
         chrom, pos, alt = (row['chrom'], int(row['pos'] - 1), row['alt'])
         gene, nt_pos, aa_pos, aa_alt, desc = ("", 0, 0, "", "")
-        genes = annots.get(row['chrom'], [])
-        genes = [g for g in genes if g.start <= pos and g.end > pos]
+        genes = allele_genes[i]
         # Any SNP mapping to multiple genes is annotated as such (no automatic resolution to one gene)
         if len(genes) > 1:
             gene = str(len(genes))
@@ -124,10 +229,50 @@ def enhance_allele_info(vcf_allele_info, fasta_path, annots_path, sequin_format=
     return vcf_alleles_extended
 
 
-def fasta_chrom_sizes(fasta_path):
+def encode_allele_info(vcf_alleles_extended):
+    """
+    Dictionary-encodes the `gene` and `desc` columns of an array produced by `enhance_allele_info()`.
+    
+    Returns the encoded array, with the ALLELE_INFO_ENCODED_DTYPE, and a dictionary with a sorted
+    table of unique strings for each encoded column, so that e.g. `tables['gene'][row['gene']]` is
+    the gene for `row`. See `decode_allele_info()` to reverse this.
+    """
+    vcf_alleles_encoded = np.zeros(len(vcf_alleles_extended), dtype=ALLELE_INFO_ENCODED_DTYPE)
+    tables = {}
+    for name in ALLELE_INFO_ENCODED_DTYPE.names:
+        if name in ENCODED_ALLELE_INFO_FIELDS:
+            tables[name], vcf_alleles_encoded[name] = np.unique(vcf_alleles_extended[name], 
+                    return_inverse=True)
+        else:
+            vcf_alleles_encoded[name] = vcf_alleles_extended[name]
+    return vcf_alleles_encoded, tables
+
+
+def decode_allele_column(vcf_alleles_encoded, tables, name):
+    """
+    Decodes one column of an array produced by `encode_allele_info()`, returning an array of strings.
+    Columns that aren't encoded are returned as they are.
+    """
+    if name in ENCODED_ALLELE_INFO_FIELDS:
+        return tables[name][vcf_alleles_encoded[name]]
+    return vcf_alleles_encoded[name]
+
+
+def decode_allele_info(vcf_alleles_encoded, tables):
+    """Reverses `encode_allele_info()`, returning an array with the ALLELE_INFO_EXTENDED_DTYPE."""
+    vcf_alleles_extended = np.zeros(len(vcf_alleles_encoded), dtype=ALLELE_INFO_EXTENDED_DTYPE)
+    for name in ALLELE_INFO_EXTENDED_DTYPE.names:
+        vcf_alleles_extended[name] = decode_allele_column(vcf_alleles_encoded, tables, name)
+    return vcf_alleles_extended
+
+
+def fasta_chrom_sizes(fasta_path, cache_dir=None):
     """
     Given the path to a fasta file, return a NumPy array of (sequence name, size) tuples.
+    If `cache_dir` is given, the fasta file is loaded via the cache in that directory.
     """
+    if cache_dir is not None:
+        return np.array(load_chrom_sizes(fasta_path, cache_dir), dtype=CHROM_SIZES_DTYPE)
     # Load the fasta's contigs as SeqRecords into their own dictionary.
     fasta_contigs = list(SeqIO.parse(open(fasta_path), "fasta"))
     chrom_sizes = np.zeros(len(fasta_contigs), dtype=CHROM_SIZES_DTYPE)
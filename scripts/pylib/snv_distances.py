@@ -0,0 +1,138 @@
+import numpy as np
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from tqdm import tqdm
+
+from .packed_genotypes import popcount64
+
+# Rows and columns of the distance matrix are computed in square tiles of this many sequences
+DEFAULT_TILE_SIZE = 32
+# Variants are compared in chunks small enough that the temporary array of comparisons for one
+# tile stays around this size, so that it fits in cache
+TILE_BYTES = 1 << 20
+# With more than one worker, tiles are split into this many batches per worker, to even out load
+BATCHES_PER_WORKER = 4
+
+# Arrays inherited by forked worker processes, so they are never pickled; see `_accumulate_batch()`
+_worker_arrays = {}
+
+
+def upper_tiles(n_seqs, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Returns a list of (row_start, row_end, col_start, col_end) tiles that cover the upper triangle
+    (including the diagonal) of an (n_seqs, n_seqs) matrix.
+    """
+    starts = range(0, n_seqs, tile_size)
+    return [(i, min(i + tile_size, n_seqs), j, min(j + tile_size, n_seqs))
+            for i in starts for j in starts if j >= i]
+
+
+def variant_chunks(genotypes, tile_size=DEFAULT_TILE_SIZE, packed=False):
+    """
+    Yields contiguous in-memory chunks of `genotypes` along the variant axis, each sized so that
+    comparing one tile of it fits in TILE_BYTES. Chunks are read in order, so a memory-mapped
+    matrix of alleles is read through only once.
+    """
+    if packed:
+        words = np.ascontiguousarray(genotypes).view(np.uint64)
+        step = max(1, TILE_BYTES // (tile_size * tile_size * 8 * max(1, words.shape[0])))
+        for start in range(0, words.shape[2], step):
+            yield np.ascontiguousarray(words[:, :, start:start + step])
+    else:
+        step = max(64, TILE_BYTES // (tile_size * tile_size))
+        for start in range(0, genotypes.shape[1], step):
+            yield np.ascontiguousarray(genotypes[:, start:start + step])
+
+
+def tile_distances(chunk, tile, packed=False):
+    """
+    Counts the variants in `chunk` at which the sequences for the rows of `tile` differ from the
+    sequences for the columns of `tile`, by broadcasting the rows against the columns.
+    """
+    i0, i1, j0, j1 = tile
+    if packed:
+        diffs = np.bitwise_or.reduce(chunk[:, i0:i1, None, :] ^ chunk[:, None, j0:j1, :], axis=0)
+        return popcount64(diffs).sum(axis=2, dtype=np.int64)
+    return (chunk[i0:i1, None, :] != chunk[None, j0:j1, :]).sum(axis=2, dtype=np.int32)
+
+
+def accumulate_tiles(genotypes, tiles, out, tile_size=DEFAULT_TILE_SIZE, packed=False,
+        progress=False):
+    """Adds the distances for each of `tiles` into the corresponding block of `out`."""
+    chunks = variant_chunks(genotypes, tile_size, packed)
+    if progress:
+        n_variants = genotypes.shape[2] * 64 if packed else genotypes.shape[1]
+        pbar = tqdm(total=n_variants, desc="Calculating SNV distances")
+    for chunk in chunks:
+        for tile in tiles:
+            out[tile[0]:tile[1], tile[2]:tile[3]] += tile_distances(chunk, tile, packed)
+        if progress:
+            pbar.update(chunk.shape[-1] * 64 if packed else chunk.shape[1])
+    if progress:
+        pbar.close()
+
+
+def mirror_tiles(tiles, out):
+    """Copies the upper triangle of `out`, as computed for `tiles`, into the lower triangle."""
+    for i0, i1, j0, j1 in tiles:
+        if j0 > i0:
+            out[j0:j1, i0:i1] = out[i0:i1, j0:j1].T
+
+
+def _accumulate_batch(args):
+    tiles, tile_size, packed = args
+    accumulate_tiles(_worker_arrays['genotypes'], tiles, _worker_arrays['out'], tile_size, packed)
+    return len(tiles)
+
+
+def snv_distances(genotypes, packed=False, tile_size=DEFAULT_TILE_SIZE, progress=False, 
+        workers=1):
+    """
+    Calculates the number of variants at which each pair of sequences differs. `genotypes` is
+    either the (sequences, variants) matrix of alleles from `load_parsnp_vcf()`, or if `packed`
+    is True, the bit-planes from `pack_genotypes()`.
+
+    Only the upper triangle is computed, tile by tile; returns a symmetric (sequences, sequences)
+    matrix of distances as np.int64.
+    
+    If `workers` > 1, batches of tiles are computed by a pool of that many processes. They are 
+    forked after `genotypes` and a distance matrix in shared memory are set aside for them, so
+    neither is copied; if `genotypes` is memory-mapped, the workers all read from the page cache.
+    """
+    n_seqs = genotypes.shape[1] if packed else genotypes.shape[0]
+    tiles = upper_tiles(n_seqs, tile_size)
+    if workers <= 1:
+        dist_mat = np.zeros((n_seqs, n_seqs), dtype=np.int64)
+        accumulate_tiles(genotypes, tiles, dist_mat, tile_size, packed, progress)
+    else:
+        dist_mat = np.frombuffer(RawArray('b', n_seqs * n_seqs * 8), dtype=np.int64)
+        dist_mat = dist_mat.reshape((n_seqs, n_seqs))
+        n_batches = min(len(tiles), workers * BATCHES_PER_WORKER)
+        batches = [(tiles[i::n_batches], tile_size, packed) for i in range(n_batches)]
+        _worker_arrays.update(genotypes=genotypes, out=dist_mat)
+        pool = multiprocessing.Pool(workers)
+        try:
+            done = pool.imap_unordered(_accumulate_batch, batches)
+            if progress:
+                done = tqdm(done, total=len(batches), desc="Calculating SNV distances")
+            for _ in done: pass
+        finally:
+            pool.terminate()
+            _worker_arrays.clear()
+    mirror_tiles(tiles, dist_mat)
+    return dist_mat
+
+
+def write_distance_tsv(path, seq_list, dist_mat):
+    """
+    Writes the matrix of distances between the sequences in `seq_list` to a .tsv file at `path`,
+    with a header row and column of sequence names. Distances are written out as floats, as they
+    always have been, e.g. "12.0".
+    """
+    dist_mat = dist_mat.astype(float)
+    with open(path, 'w') as out:
+        out.write('strains\t' + '\t'.join(seq_list) + '\n')
+        for i, seq1 in enumerate(seq_list):
+            out.write(seq1 + '\t')
+            out.write('\t'.join(map(str, dist_mat[i, :])))
+            out.write('\n')
@@ -0,0 +1,76 @@
+"""
+Tests for parsnp_npz_server.py. Run from the scripts/ directory with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pylib.parsnp_vcf import ALLELE_INFO_DTYPE
+from parsnp_npz_server import ParsnpNpzServer
+
+
+def shared_reference_npz(path, n_clusters=4, n_genomes=3, n_variants=20, seed=0):
+    """Saves an .npz in which every cluster starts with the same reference genome, named REF."""
+    rand = np.random.RandomState(seed)
+    vcf_data = {}
+    for i in range(n_clusters):
+        alleles = rand.randint(0, 3, size=(n_variants, n_genomes)).astype(np.int16)
+        alleles[:, 0] = 0
+        allele_info = np.zeros(n_variants, dtype=ALLELE_INFO_DTYPE)
+        allele_info['chrom'] = 'chr1'
+        allele_info['pos'] = np.arange(1, n_variants + 1) * 10
+        allele_info['alt'] = 'A,C,G'
+        vcf_data['vcf_mat_%d' % i] = alleles.T
+        vcf_data['vcf_allele_info_%d' % i] = allele_info
+        vcf_data['seq_list_%d' % i] = np.array(['REF'] + ['C%dG%d' % (i, j) for j in
+                range(1, n_genomes)])
+    np.savez(path, **vcf_data)
+
+
+class ParsnpNpzServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        npz_path = os.path.join(self.tmp_dir, 'test.parsnp.vcfs.npz')
+        shared_reference_npz(npz_path)
+        self.server = ParsnpNpzServer(('127.0.0.1', 0), npz_path, quiet=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def get(self, path):
+        url = 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+        return json.load(urllib2.urlopen(url))
+
+    def test_cluster_requests_return_that_cluster_when_genome_names_repeat(self):
+        for endpoint in ('genotypes', 'alleles', 'distances'):
+            for cluster in range(4):
+                response = self.get('/%s?cluster=%d' % (endpoint, cluster))
+                self.assertEqual(response['cluster'], cluster)
+                self.assertEqual(response['genomes'], ['REF', 'C%dG1' % cluster, 'C%dG2' % cluster])
+
+    def test_cluster_requests_within_a_range(self):
+        for cluster in range(4):
+            response = self.get('/genotypes?cluster=%d&chrom=chr1&start=50&end=150' % cluster)
+            self.assertEqual(response['cluster'], cluster)
+            self.assertTrue(all(50 <= pos <= 150 for pos in response['allele_info']['pos']))
+
+
+if __name__ == '__main__':
+    unittest.main()